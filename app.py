@@ -1,14 +1,67 @@
 import streamlit as st
 import pandas as pd
-import google.generativeai as genai
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 import json
 import os
-from datetime import datetime
-import PyPDF2
 from io import BytesIO
 import re
+import sqlite3
+import threading
+import time
+import tempfile
+import shutil
+import atexit
+from collections import deque
+from contextlib import contextmanager
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from saresp_core import (
+    LONGITUDINAL_ALL_SERIES,
+    apply_filters_to_dataframe,
+    build_agent_prompt,
+    build_dataset_entry,
+    build_longitudinal_table,
+    build_store_entry,
+    create_data_context,
+    create_gemini_model,
+    cube_group_means,
+    cube_level_counts,
+    cube_metric_stats,
+    entry_resident_bytes,
+    extract_filters_from_prompt,
+    filter_dataset_entry,
+    filter_mask,
+    format_longitudinal_context,
+    full_cube_view,
+    full_store_view,
+    get_api_key,
+    get_entry_df,
+    load_manifest_ranking,
+    load_shard_manifest,
+    logger,
+    longitudinal_key,
+    lookup_school_evolution,
+    page_in_dataframe,
+    query_cube,
+    query_store,
+    quote_identifier,
+    read_data_file,
+    read_store_rows,
+    save_to_store,
+    school_key,
+    select_view_sketches,
+    sketch_histogram,
+    sketch_quantile,
+    sketch_stats,
+    spill_dataframe,
+    store_connection,
+    store_group_means,
+    store_metric_stats,
+    store_value_counts,
+)
 
 # Configuração da página
 st.set_page_config(
@@ -56,415 +109,525 @@ if 'gemini_model' not in st.session_state:
     st.session_state.gemini_model = None
 if 'last_filters' not in st.session_state:
     st.session_state.last_filters = None
+if 'shard_manifest' not in st.session_state:
+    st.session_state.shard_manifest = None
+if 'spill_dir' not in st.session_state:
+    st.session_state.spill_dir = None
+if 'routing_stats' not in st.session_state:
+    st.session_state.routing_stats = {'direta': 0, 'gemini': 0}
+if 'store_attached' not in st.session_state:
+    st.session_state.store_attached = False
+if 'perf_timings' not in st.session_state:
+    st.session_state.perf_timings = {}
+if 'export_view' not in st.session_state:
+    st.session_state.export_view = None
+if 'export_job' not in st.session_state:
+    st.session_state.export_job = None
+if 'longitudinal' not in st.session_state:
+    st.session_state.longitudinal = None
+if 'longitudinal_key' not in st.session_state:
+    st.session_state.longitudinal_key = None
+
+@contextmanager
+def timed_stage(name):
+    """Mede uma etapa do turno; durações ficam em st.session_state.perf_timings (usado pelo loadtest.py)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        st.session_state.perf_timings.setdefault(name, deque(maxlen=1000)).append(elapsed)
+        logger.debug("etapa=%s duracao=%.3fs", name, elapsed)
 
 def init_gemini():
     """Inicializa o modelo Gemini com o modelo correto"""
     try:
-        api_key = st.secrets.get("GOOGLE_API_KEY", os.getenv("GOOGLE_API_KEY"))
+        api_key = get_api_key()
         if not api_key:
             st.error("⚠️ Configure GOOGLE_API_KEY nas secrets")
             st.stop()
         
-        genai.configure(api_key=api_key)
-               
-        model = genai.GenerativeModel('gemini-2.5-pro')
+        model = create_gemini_model(api_key)
         st.session_state.gemini_model = model
         return model
     except Exception as e:
         st.error(f"Erro ao configurar Gemini: {e}")
         st.stop()
 
-def normalize_column_names(df):
-    """Normaliza nomes de colunas para padrão consistente"""
-    column_mapping = {}
-    
-    for col in df.columns:
-        col_lower = col.lower().strip()
-        
-        # Mapeamento para colunas padrão
-        if 'código' in col_lower and 'escola' in col_lower or 'codesc' in col_lower:
-            column_mapping[col] = 'codigo_escola'
-        elif 'nome' in col_lower and 'escola' in col_lower or 'nomesc' in col_lower:
-            column_mapping[col] = 'nome_escola'
-        elif col_lower in ['serie_ano', 'série_ano', 'serie', 'ano']:
-            column_mapping[col] = 'serie_ano'
-        elif col_lower == 'turma':
-            column_mapping[col] = 'turma'
-        elif col_lower == 'sexo':
-            column_mapping[col] = 'sexo'
-    
-    if column_mapping:
-        df = df.rename(columns=column_mapping)
-    
-    return df
-
 def load_data_file(file):
     """Carrega arquivo e retorna DataFrame com colunas normalizadas"""
     try:
-        ext = file.name.split('.')[-1].lower()
-        
-        if ext in ['xlsx', 'xls']:
-            df = pd.read_excel(file)
-        elif ext == 'csv':
-            df = pd.read_csv(file)
-        elif ext == 'pdf':
-            pdf = PyPDF2.PdfReader(file)
-            text = "\n".join([page.extract_text() for page in pdf.pages])
-            return None, text
-        else:
-            return None, None
-        
-        # Normaliza nomes de colunas
-        df = normalize_column_names(df)
-        
-        return df, None
+        return read_data_file(file)
     except Exception as e:
         st.error(f"Erro ao carregar {file.name}: {e}")
         return None, None
 
-def analyze_dataframe(df, filename, filters_info=None):
-    """Analisa DataFrame e retorna resumo estruturado"""
-    
-    if df.empty:
-        return {
-            'filename': filename,
-            'total_alunos': 0,
-            'colunas': [],
-            'tipo': 'Nenhum dado encontrado',
-            'filters_applied': filters_info
-        }
+# Orçamentos de memória para os DataFrames de alunos (MB)
+SESSION_MEMORY_BUDGET_MB = float(os.getenv("SARESP_SESSION_MEMORY_MB", "512"))
+PROCESS_MEMORY_BUDGET_MB = float(os.getenv("SARESP_PROCESS_MEMORY_MB", "2048"))
+
+def remove_spill_dirs(registry):
+    """Apaga os diretórios temporários de todas as sessões registradas"""
+    for path in list(registry['spill_dirs'].values()):
+        shutil.rmtree(path, ignore_errors=True)
+
+@st.cache_resource
+def get_memory_registry():
+    """Registro compartilhado entre as sessões do processo (bytes residentes e diretório temporário por sessão)"""
+    registry = {'lock': threading.Lock(), 'sessions': {}, 'spill_dirs': {}}
+    # Diretórios que sobrarem (sessões ainda abertas) são removidos ao encerrar o processo
+    atexit.register(remove_spill_dirs, registry)
+    return registry
+
+def current_session_id():
+    """Identificador da sessão Streamlit atual ('local' fora do servidor)"""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else 'local'
+
+def format_bytes(num_bytes):
+    """Formata tamanho em bytes para exibição"""
+    for unit in ['B', 'KB', 'MB']:
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
 
-    analysis = {
-        'filename': filename,
-        'total_alunos': len(df),
-        'total_colunas': len(df.columns),
-        'colunas': list(df.columns),
-        'filters_applied': filters_info
+def get_spill_dir():
+    """Diretório temporário da sessão para DataFrames despejados em disco (recriado se tiver sido apagado)"""
+    if not st.session_state.get('spill_dir'):
+        st.session_state.spill_dir = tempfile.mkdtemp(prefix='saresp_spill_')
+    elif not os.path.isdir(st.session_state.spill_dir):
+        os.makedirs(st.session_state.spill_dir, exist_ok=True)
+    registry = get_memory_registry()
+    with registry['lock']:
+        registry['spill_dirs'][current_session_id()] = st.session_state.spill_dir
+    return st.session_state.spill_dir
+
+def session_exists(session_id):
+    """Sessão ainda conhecida pelo servidor: ativa ou desconectada (pode reconectar com o mesmo estado)"""
+    session_mgr = getattr(runtime.get_instance(), '_session_mgr', None)
+    if session_mgr is None:
+        return runtime.get_instance().is_active_session(session_id)
+    return session_mgr.get_session_info(session_id) is not None
+
+def spill_entry(info):
+    """Despeja um arquivo em disco e libera o DataFrame da memória; retorna bytes liberados"""
+    freed = entry_resident_bytes(info)
+    # Arquivos do banco já estão em disco: basta soltar o DataFrame
+    if info.get('spill') is None and not info.get('store'):
+        info['spill'] = spill_dataframe(info['df'], tempfile.mkdtemp(dir=get_spill_dir()))
+    info['df'] = None
+    return freed
+
+def get_memory_usage():
+    """Resumo de memória da sessão e do processo"""
+    entries = st.session_state.dataframes.values()
+    registry = get_memory_registry()
+    with registry['lock']:
+        process_bytes = sum(registry['sessions'].values())
+    return {
+        'session_resident': sum(entry_resident_bytes(info) for info in entries),
+        'session_spilled': sum(info['spill']['nbytes'] for info in entries if info.get('spill')),
+        'process_resident': process_bytes
     }
+
+def enforce_memory_budget():
+    """Despeja em disco os arquivos menos usados enquanto a sessão ou o processo estiverem acima do orçamento"""
+    entries = st.session_state.dataframes
+    registry = get_memory_registry()
+    session_id = current_session_id()
+    session_budget = SESSION_MEMORY_BUDGET_MB * 1024 ** 2
+    process_budget = PROCESS_MEMORY_BUDGET_MB * 1024 ** 2
     
-    # Identifica tipo de dados
-    if 'profic_lp' in df.columns:
-        analysis['tipo'] = 'EFAI - Anos Iniciais'
-        analysis['disciplinas'] = ['Língua Portuguesa', 'Matemática']
-    elif 'nota_ch' in df.columns:
-        analysis['tipo'] = 'EFAF - Anos Finais'
-        analysis['disciplinas'] = ['LP', 'Inglês', 'Ciências', 'Matemática', 'História', 'Geografia']
-    elif 'nota_fil' in df.columns:
-        analysis['tipo'] = 'EM - Ensino Médio'
-        analysis['disciplinas'] = ['LP', 'Inglês', 'Biologia', 'Física', 'Química', 'Matemática', 'Geografia', 'História', 'Filosofia']
-    else:
-        analysis['tipo'] = 'Genérico'
-        analysis['disciplinas'] = []
-    
-    # Estatísticas de notas principais
-    if 'nota_lp' in df.columns and pd.api.types.is_numeric_dtype(df['nota_lp']):
-        analysis['media_lp'] = round(df['nota_lp'].mean(), 2)
-        analysis['min_lp'] = round(df['nota_lp'].min(), 2)
-        analysis['max_lp'] = round(df['nota_lp'].max(), 2)
-    
-    if 'nota_mat' in df.columns and pd.api.types.is_numeric_dtype(df['nota_mat']):
-        analysis['media_mat'] = round(df['nota_mat'].mean(), 2)
-        analysis['min_mat'] = round(df['nota_mat'].min(), 2)
-        analysis['max_mat'] = round(df['nota_mat'].max(), 2)
-    
-    # Estatísticas de todas as métricas numéricas
-    numeric_cols = [col for col in df.columns if 
-                    (col.startswith('nota_') or 
-                     col.startswith('profic_') or 
-                     col.startswith('porc_') or
-                     col.startswith('acertos_')) and 
-                    pd.api.types.is_numeric_dtype(df[col])]
-    
-    analysis['numeric_stats'] = {}
-    for col in numeric_cols:
-        analysis['numeric_stats'][col] = {
-            'media': round(df[col].mean(), 2),
-            'min': round(df[col].min(), 2),
-            'max': round(df[col].max(), 2),
-            'mediana': round(df[col].median(), 2)
-        }
-    
-    # Distribuições de níveis
-    level_cols = [col for col in df.columns if 
-                  col.startswith('nivel_profic_') or 
-                  col.startswith('nivSaeb_') or
-                  col.startswith('classific_')]
-    
-    analysis['level_distributions'] = {}
-    for col in level_cols:
-        if col in df.columns:
-            distribution = df[col].value_counts(normalize=True) * 100
-            analysis['level_distributions'][col] = distribution.round(2).to_dict()
-    
-    # Informações de agrupamento
-    if 'serie_ano' in df.columns:
-        analysis['series'] = df['serie_ano'].value_counts().to_dict()
-    
-    if 'sexo' in df.columns:
-        analysis['genero'] = df['sexo'].value_counts().to_dict()
+    session_bytes = sum(entry_resident_bytes(info) for info in entries.values())
+    with registry['lock']:
+        # Remove sessões encerradas do registro e apaga os arquivos despejados/exportados delas;
+        # sessões só desconectadas continuam no gerenciador e mantêm seus arquivos
+        if runtime.exists():
+            for other_id in set(registry['sessions']) | set(registry['spill_dirs']):
+                if not session_exists(other_id):
+                    registry['sessions'].pop(other_id, None)
+                    spill_dir = registry['spill_dirs'].pop(other_id, None)
+                    if spill_dir:
+                        shutil.rmtree(spill_dir, ignore_errors=True)
+        registry['sessions'][session_id] = session_bytes
+        other_bytes = sum(b for sid, b in registry['sessions'].items() if sid != session_id)
     
-    if 'turma' in df.columns:
-        analysis['turmas'] = df['turma'].value_counts().to_dict()
+    coldest_first = sorted(entries.items(), key=lambda item: item[1]['last_access'])
+    for _, info in coldest_first:
+        if session_bytes <= session_budget and session_bytes + other_bytes <= process_budget:
+            break
+        if entry_resident_bytes(info) == 0:
+            continue
+        session_bytes -= spill_entry(info)
     
-    if 'nome_escola' in df.columns:
-        analysis['num_escolas'] = df['nome_escola'].nunique()
-        analysis['nomes_escolas'] = df['nome_escola'].unique().tolist()[:10]  # Limita a 10
+    with registry['lock']:
+        registry['sessions'][session_id] = session_bytes
+
+def release_session_memory():
+    """Remove arquivos despejados e o registro da sessão (ao limpar tudo)"""
+    if st.session_state.get('spill_dir'):
+        shutil.rmtree(st.session_state.spill_dir, ignore_errors=True)
+        st.session_state.spill_dir = None
+    registry = get_memory_registry()
+    with registry['lock']:
+        registry['sessions'].pop(current_session_id(), None)
+        registry['spill_dirs'].pop(current_session_id(), None)
+
+def load_school_shards(codigo_escola):
+    """Carrega sob demanda os shards pré-processados de uma escola para a sessão"""
+    manifest = st.session_state.shard_manifest
+    if not manifest:
+        return []
     
-    if 'codigo_escola' in df.columns:
-        analysis['num_cod_escolas'] = df['codigo_escola'].nunique()
-        analysis['cods_escolas'] = df['codigo_escola'].unique().tolist()[:10]  # Limita a 10
+    loaded = []
+    key = school_key(codigo_escola)
+    for filename, file_info in manifest['arquivos'].items():
+        school = file_info['escolas'].get(key)
+        if not school:
+            continue
+        
+        entry_name = f"{filename} · escola {key}"
+        if entry_name not in st.session_state.dataframes:
+            df = pd.read_parquet(os.path.join(manifest['base_dir'], school['shard']))
+            entry = build_dataset_entry(df, entry_name)
+            # A posição da escola é em relação ao arquivo estadual, não ao shard
+            entry['ranking'] = load_manifest_ranking(manifest, filename)
+            entry['shard'] = True
+            st.session_state.dataframes[entry_name] = entry
+        loaded.append(entry_name)
     
-    return analysis
-
-def extract_filters_from_prompt(prompt):
-    """Extrai filtros do prompt do usuário de forma inteligente"""
-    filters = {
-        'codigo_escola': None,
-        'nome_escola': None,
-        'turma': None,
-        'serie_ano': None,
-        'sexo': None
-    }
+    return loaded
+
+# Armazenamento analítico opcional em SQLite, compartilhado entre os processos do app
+SQLITE_STORE_PATH = os.getenv("SARESP_SQLITE_PATH", "")
+
+def attach_store_entries(path):
+    """Disponibiliza na sessão os arquivos do banco (gravados por qualquer processo do app)"""
+    with store_connection(path) as conn:
+        catalog = conn.execute("SELECT arquivo, tabela, analise, ranking FROM catalogo ORDER BY carregado_em").fetchall()
     
+    attached = []
+    for filename, table, analysis, ranking_meta in catalog:
+        if filename not in st.session_state.dataframes:
+            st.session_state.dataframes[filename] = build_store_entry(
+                path, table, json.loads(analysis), json.loads(ranking_meta) if ranking_meta else None
+            )
+            attached.append(filename)
+    return attached
+# Perguntas sobre evolução entre edições (modo longitudinal)
+LONGITUDINAL_KEYWORDS = [
+    'evolução', 'evolucao', 'evoluiu', 'tendência', 'tendencia', 'ao longo dos anos', 'ano a ano',
+    'entre os anos', 'histórico', 'historico', 'ano anterior', 'anos anteriores', 'ano passado', 'edições', 'edicoes'
+]
+
+def refresh_longitudinal():
+    """Recalcula a tabela longitudinal da sessão no carregamento dos arquivos (não a cada pergunta)"""
+    key = longitudinal_key(st.session_state.dataframes)
+    if st.session_state.longitudinal_key == key:
+        return st.session_state.longitudinal
+    st.session_state.longitudinal = build_longitudinal_table(st.session_state.dataframes)
+    st.session_state.longitudinal_key = key
+    return st.session_state.longitudinal
+
+def extract_edition_year(prompt, filters):
+    """Ano de edição citado na pergunta ("em 2022", "SARESP 2022"), sem confundir com o código da escola"""
+    match = re.search(r'(?:\bem|\bde|\bdo|edição|edicao|saresp|\bano)\s+(20\d{2})\b', prompt.lower())
+    if not match or str(filters.get('codigo_escola')) == match.group(1):
+        return None
+    return int(match.group(1))
+
+def entries_by_edition(year=None):
+    """Arquivos da sessão na ordem de consulta: com várias edições carregadas, a mais recente primeiro;
+    com `year`, só os arquivos dessa edição (lista vazia se ela não foi carregada)"""
+    entries = list(st.session_state.dataframes.items())
+    if year is not None:
+        return [(filename, info) for filename, info in entries if info['analysis'].get('ano_edicao') == year]
+    if st.session_state.longitudinal:
+        entries.sort(key=lambda item: -(item[1]['analysis'].get('ano_edicao') or 0))
+    return entries
+
+def is_longitudinal_request(prompt):
+    """Pergunta sobre evolução/tendência entre edições"""
     prompt_lower = prompt.lower()
+    return any(word in prompt_lower for word in LONGITUDINAL_KEYWORDS)
+
+# Exportação dos alunos do recorte atual, gravada em blocos numa thread
+EXPORT_CHUNK_ROWS = 50_000
+EXPORT_FORMATS = {'CSV': 'csv', 'Parquet (compacto)': 'parquet'}
+EXPORT_MIME_TYPES = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+def prepare_export(info, filters):
+    """Resolve as linhas do recorte (posições ou consulta no banco) antes de exportar em segundo plano"""
+    if info.get('store'):
+        view = query_store(info, filters)
+        if view is None:
+            return None
+        return {'view': view, 'total': store_metric_stats(view, [], medians=False)['total']}
     
-    # 1. CÓDIGO DA ESCOLA
-    # Padrões: "código 5174", "escola 5174", "código da escola 5174", "cod 5174"
-    patterns_codigo = [
-        r'(?:c[oó]digo\s+(?:da\s+)?escola|escola|cod\.?)\s+(\d{4,6})',
-        r'(?:escola\s+de\s+c[oó]digo|com\s+c[oó]digo)\s+(\d{4,6})'
-    ]
-    
-    for pattern in patterns_codigo:
-        match = re.search(pattern, prompt_lower)
-        if match:
-            filters['codigo_escola'] = int(match.group(1))
-            break
-    
-    # 2. NOME DA ESCOLA (mais complexo)
-    # Padrões: "da escola [NOME]", "escola [NOME]"
-    patterns_nome = [
-        r'(?:da\s+escola|escola)\s+([A-ZÁÉÍÓÚÂÊÎÔÛÃÕ][A-ZÁÉÍÓÚÂÊÎÔÛÃÕa-záéíóúâêîôûãõ\s\.]{5,})',
-        r'(?:na\s+escola|para\s+a\s+escola)\s+([A-ZÁÉÍÓÚÂÊÎÔÛÃÕ][A-ZÁÉÍÓÚÂÊÎÔÛÃÕa-záéíóúâêîôûãõ\s\.]{5,})'
-    ]
-    
-    for pattern in patterns_nome:
-        match = re.search(pattern, prompt, re.IGNORECASE)
-        if match and not filters['codigo_escola']:  # Só usa nome se não achou código
-            filters['nome_escola'] = match.group(1).strip()
-            break
-    
-    # 3. TURMA
-    # Padrões: "turma A", "turma 6A", "da turma B"
-    match = re.search(r'(?:turma|da\s+turma)\s+([A-Z0-9]{1,3})', prompt, re.IGNORECASE)
-    if match:
-        filters['turma'] = match.group(1).upper()
+    # Referência ao DataFrame (ou aos arquivos despejados) tomada agora: a thread não depende da sessão
+    df = info['df']
+    if df is not None:
+        mask, applied = filter_mask(df, filters)
+    else:
+        mask, applied = filter_mask(page_in_dataframe(info['spill'], columns=list(filters)), filters)
+    if not applied:
+        return None
     
-    # 4. SÉRIE/ANO
-    # Padrões: "6º ano", "série 6", "do 7º", "ano 5"
-    patterns_serie = [
-        r'(\d+)[ºª°]?\s*(?:ano|série)',
-        r'(?:ano|série)\s+(\d+)',
-        r'do\s+(\d+)[ºª°]'
-    ]
+    positions = np.flatnonzero(mask)
+    return {'df': df, 'spill': info.get('spill'), 'positions': positions, 'total': len(positions)}
+
+def iter_export_chunks(plan):
+    """Blocos de alunos do recorte, sem montar uma cópia inteira na memória"""
+    if 'view' in plan:
+        view = plan['view']
+        store = view['info']['store']
+        with store_connection(store['path']) as conn:
+            yield from pd.read_sql(
+                f"SELECT * FROM {quote_identifier(store['table'])} WHERE {view['where']} ORDER BY rowid",
+                conn, params=view['params'], chunksize=EXPORT_CHUNK_ROWS
+            )
+        return
     
-    for pattern in patterns_serie:
-        match = re.search(pattern, prompt_lower)
-        if match:
-            filters['serie_ano'] = match.group(1)
-            break
+    positions = plan['positions']
+    for start in range(0, len(positions), EXPORT_CHUNK_ROWS):
+        rows = positions[start:start + EXPORT_CHUNK_ROWS]
+        if plan['df'] is not None:
+            yield plan['df'].iloc[rows]
+        else:
+            yield page_in_dataframe(plan['spill'], rows=rows)
+
+def arrow_schema(chunk):
+    """Esquema Parquet do primeiro bloco (texto e tipos misturados viram string)"""
+    import pyarrow as pa
     
-    # 5. SEXO/GÊNERO
-    if any(word in prompt_lower for word in ['feminino', 'femininas', 'meninas', 'alunas']):
-        filters['sexo'] = 'F'
-    elif any(word in prompt_lower for word in ['masculino', 'masculinos', 'meninos', 'alunos']):
-        filters['sexo'] = 'M'
+    fields = []
+    for col in chunk.columns:
+        dtype = chunk[col].dtype
+        if pd.api.types.is_bool_dtype(dtype):
+            arrow_type = pa.bool_()
+        elif pd.api.types.is_integer_dtype(dtype):
+            arrow_type = pa.int64()
+        elif pd.api.types.is_float_dtype(dtype):
+            arrow_type = pa.float64()
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            arrow_type = pa.timestamp('ns')
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(str(col), arrow_type))
+    return pa.schema(fields)
+
+def write_export(plan, path, file_format, job):
+    """Grava o recorte em blocos (roda em thread; o progresso fica em job)"""
+    try:
+        if file_format == 'csv':
+            # BOM para o Excel reconhecer os acentos
+            with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+                for idx, chunk in enumerate(iter_export_chunks(plan)):
+                    chunk.to_csv(f, header=idx == 0, index=False)
+                    job['linhas'] += len(chunk)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            
+            writer = None
+            try:
+                for chunk in iter_export_chunks(plan):
+                    if writer is None:
+                        schema = arrow_schema(chunk)
+                        writer = pq.ParquetWriter(path, schema, compression='zstd')
+                    for field in schema:
+                        if pa.types.is_string(field.type):
+                            chunk = chunk.assign(**{field.name: chunk[field.name].where(
+                                chunk[field.name].isna(), chunk[field.name].astype(str))})
+                    writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                    job['linhas'] += len(chunk)
+            finally:
+                if writer is not None:
+                    writer.close()
+        job['status'] = 'pronto'
+    except Exception as e:
+        logger.exception("falha ao exportar recorte para %s", path)
+        job['status'] = 'erro'
+        job['erro'] = str(e)
+
+def export_file_name(filters, file_format):
+    """Nome do arquivo baixado a partir dos filtros (ex.: alunos_turma-6A.csv)"""
+    parts = [f"{key.split('_')[0]}-{value}" for key, value in filters.items()]
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', "alunos_" + "_".join(parts)) + f".{file_format}"
+
+def start_export(export_view, file_format):
+    """Inicia a exportação do recorte atual em segundo plano"""
+    info = st.session_state.dataframes[export_view['filename']]
+    plan = prepare_export(info, export_view['filters'])
+    if plan is None:
+        st.warning("Nenhum aluno encontrado para os filtros atuais")
+        return
     
-    # Remove None values
-    filters = {k: v for k, v in filters.items() if v is not None}
+    # Arquivo anterior (já concluído) é descartado
+    previous = st.session_state.export_job
+    if previous and previous['status'] != 'gerando' and os.path.exists(previous['path']):
+        os.remove(previous['path'])
     
-    return filters
+    path = os.path.join(get_spill_dir(), f"export_{time.time_ns()}.{file_format}")
+    job = {
+        'status': 'gerando',
+        'linhas': 0,
+        'total': plan['total'],
+        'path': path,
+        'formato': file_format,
+        'nome': export_file_name(export_view['filters'], file_format),
+        'filtros': export_view['filters_applied'],
+        'erro': None
+    }
+    threading.Thread(target=write_export, args=(plan, path, file_format, job), daemon=True).start()
+    st.session_state.export_job = job
+
+# Pedidos abertos (planos, análises, explicações) sempre vão para o Gemini
+OPEN_ENDED_KEYWORDS = [
+    'plano', 'crie', 'criar', 'desenvolva', 'sugira', 'sugest', 'estratég', 'por que', 'porque',
+    'explique', 'analise', 'análise', 'atividade', 'formação', 'oficina', 'aula', 'como ',
+    'melhorar', 'intervenç', 'recomend', 'compar', 'defasagem', 'dificuldade',
+    'evolução', 'tendência', 'rede'
+]
 
-def apply_filters_to_dataframe(df, filters):
-    """Aplica filtros ao DataFrame"""
-    filtered_df = df.copy()
-    filters_applied = []
+# Perguntas sobre níveis de proficiência ("abaixo do básico") não são total nem média: vão para o Gemini
+LEVEL_KEYWORDS = ['abaixo', 'básico', 'basico', 'adequado', 'avançado', 'avancado', 'nível', 'nivel', 'níveis', 'niveis', 'profici']
+
+# Outras disciplinas: a resposta direta só cobre LP e MAT, então essas perguntas vão para o Gemini
+OTHER_SUBJECT_KEYWORDS = [
+    'ciências', 'ciencias', 'história', 'historia', 'geografia', 'inglês', 'ingles', 'biologia',
+    'física', 'fisica', 'química', 'quimica', 'filosofia', 'sociologia', 'arte', 'redação', 'redacao'
+]
+
+# Disciplinas reconhecidas nas perguntas diretas e colunas correspondentes (em ordem de preferência)
+SUBJECT_METRICS = {
+    'Língua Portuguesa': (['português', 'portugues', 'língua portuguesa', 'lingua portuguesa', ' lp'], ['nota_lp', 'profic_lp']),
+    'Matemática': (['matemática', 'matematica', ' mat'], ['nota_mat', 'profic_mat'])
+}
+
+def detect_quantitative_intent(prompt):
+    """Identifica perguntas que são só consulta de métrica (média, mediana, quartis/percentis, extremos, contagem)"""
+    prompt_lower = f" {prompt.lower().strip()} "
+    if any(word in prompt_lower for word in OPEN_ENDED_KEYWORDS + LEVEL_KEYWORDS + LONGITUDINAL_KEYWORDS) or \
+            len(prompt_lower.split()) > 15:
+        return None
+    if re.search(r'\bnota_\w+', prompt_lower) or any(re.search(rf'\b{word}\b', prompt_lower) for word in OTHER_SUBJECT_KEYWORDS):
+        return None
     
-    for key, value in filters.items():
-        if key == 'codigo_escola' and 'codigo_escola' in filtered_df.columns:
-            if value in filtered_df['codigo_escola'].values:
-                filtered_df = filtered_df[filtered_df['codigo_escola'] == value]
-                filters_applied.append(f"Código da escola: {value}")
-        
-        elif key == 'nome_escola' and 'nome_escola' in filtered_df.columns:
-            # Busca parcial case-insensitive
-            mask = filtered_df['nome_escola'].str.contains(value, case=False, na=False)
-            if mask.any():
-                filtered_df = filtered_df[mask]
-                escola_encontrada = filtered_df['nome_escola'].iloc[0]
-                filters_applied.append(f"Escola: {escola_encontrada}")
-        
-        elif key == 'turma' and 'turma' in filtered_df.columns:
-            if value in filtered_df['turma'].values:
-                filtered_df = filtered_df[filtered_df['turma'] == value]
-                filters_applied.append(f"Turma: {value}")
-        
-        elif key == 'serie_ano' and 'serie_ano' in filtered_df.columns:
-            # Tenta converter série para diferentes formatos
-            serie_str = str(value)
-            mask = (filtered_df['serie_ano'].astype(str).str.contains(serie_str, na=False))
-            if mask.any():
-                filtered_df = filtered_df[mask]
-                filters_applied.append(f"Série/Ano: {value}")
-        
-        elif key == 'sexo' and 'sexo' in filtered_df.columns:
-            if value in filtered_df['sexo'].values:
-                filtered_df = filtered_df[filtered_df['sexo'] == value]
-                genero_text = "Feminino" if value == 'F' else "Masculino"
-                filters_applied.append(f"Gênero: {genero_text}")
+    if re.search(r'quant[oa]s\s+(?:alun[oa]s|estudantes|meninos|meninas)|(?:total|número|numero)\s+de\s+alun', prompt_lower):
+        return {'tipo': 'contagem'}
     
-    if filters_applied and not filtered_df.empty:
-        return filtered_df, filters_applied
+    percentil = re.search(r'percentil\s+(\d{1,2})\b', prompt_lower)
+    if percentil:
+        estatistica = 'percentil'
+    elif re.search(r'quartil|quartis|percentil', prompt_lower):
+        estatistica = 'quartis'
+    elif re.search(r'\bmédia\b|\bmedia\b', prompt_lower):
+        estatistica = 'media'
+    elif 'mediana' in prompt_lower:
+        estatistica = 'mediana'
+    elif re.search(r'\b(?:nota\s+)?(?:mínima|minima|menor\s+nota|mínimo|minimo)\b', prompt_lower):
+        estatistica = 'min'
+    elif re.search(r'\b(?:nota\s+)?(?:máxima|maxima|maior\s+nota|máximo|maximo)\b', prompt_lower):
+        estatistica = 'max'
     else:
-        return None, None
-
-def create_data_context(filtered_df_info=None):
-    """Cria contexto consolidado de dados para o Gemini"""
-    
-    context = ""
-    data_source = {}
+        return None
     
-    if filtered_df_info:
-        # Modo filtrado
-        df = filtered_df_info['df']
-        filename = filtered_df_info['filename']
-        filters = filtered_df_info.get('filters', [])
-        
-        if df.empty:
-            return f"=== DADOS FILTRADOS ===\n\nNenhum dado encontrado para os filtros: {', '.join(filters)}\n"
-        
-        analysis = analyze_dataframe(df, filename, filters)
-        context = f"=== ANÁLISE FOCADA (FILTROS APLICADOS) ===\n\n"
-        context += f"🎯 FILTROS ATIVOS: {', '.join(filters)}\n\n"
-        data_source[filename] = {'df': df, 'analysis': analysis}
+    disciplinas = [name for name, (aliases, _) in SUBJECT_METRICS.items()
+                   if any(alias in prompt_lower for alias in aliases)]
+    return {'tipo': 'metrica', 'estatistica': estatistica, 'disciplinas': disciplinas or list(SUBJECT_METRICS),
+            'percentil': int(percentil.group(1)) if percentil else None}
+
+def answer_quantitative_question(intent, filters, edition_year=None):
+    """Responde a partir dos agregados pré-calculados (cubo e sketches) ou do banco, sem chamar o Gemini"""
+    subject_columns = [col for _, columns in SUBJECT_METRICS.values() for col in columns]
     
-    else:
-        # Modo geral
-        if not st.session_state.dataframes:
-            return "Nenhum dado foi carregado ainda."
+    # Edição citada e não carregada: o Gemini explica em vez de responder com outra edição
+    for filename, info in entries_by_edition(edition_year):
+        if info.get('store'):
+            view = query_store(info, filters) if filters else full_store_view(info)
+            if view is None:
+                continue
+            columns = [col for col in subject_columns if col in info['analysis'].get('numeric_stats', {})]
+            summary = store_metric_stats(view, columns, medians=intent.get('estatistica') == 'mediana')
+            median_label = 'mediana'
+        else:
+            cube = info.get('cube')
+            if cube is None:
+                continue
+            view = query_cube(cube, filters) if filters else full_cube_view(cube)
+            if view is None:
+                continue
+            
+            # Mediana e percentis de recortes sem sketch (turma, série, gênero) ficam com o Gemini
+            view_sketches = select_view_sketches(info, view) or {}
+            summary = {'total': int(cube['cells'].loc[view['mask'], '__rows'].sum()), 'metrics': {}}
+            for col in subject_columns:
+                if col in cube['metrics']:
+                    stats = cube_metric_stats(view, col)
+                    sketch = view_sketches.get(col)
+                    stats['mediana'] = sketch_quantile(sketch, 0.5) if sketch else None
+                    stats['quartis'] = sketch_stats(sketch) if sketch else None
+                    if intent.get('percentil') is not None:
+                        stats['percentil'] = sketch_quantile(sketch, intent['percentil'] / 100) if sketch else None
+                    summary['metrics'][col] = stats
+            median_label = 'mediana (aprox.)'
         
-        context = "=== VISÃO GERAL DE TODOS OS DADOS ===\n\n"
-        data_source = st.session_state.dataframes
-    
-    # Gera contexto detalhado
-    for filename, info in data_source.items():
-        df = info['df']
-        analysis = info['analysis']
+        lines = []
+        if intent['tipo'] == 'contagem':
+            lines.append(f"- **Total de alunos:** {summary['total']:,}".replace(',', '.'))
+        else:
+            for disciplina in intent['disciplinas']:
+                col = next((c for c in SUBJECT_METRICS[disciplina][1] if c in summary['metrics']), None)
+                if col is None:
+                    continue
+                stats = summary['metrics'][col]
+                if stats['count'] == 0:
+                    continue
+                
+                # O banco não guarda sketches: quartis e percentis dele ficam com o Gemini
+                value = stats.get(intent['estatistica'])
+                if value is None:
+                    return None
+                
+                if intent['estatistica'] == 'quartis':
+                    lines.append(f"- **{disciplina}** ({col}): 1º quartil **{round(value['p25'], 2)}** "
+                                 f"· mediana **{round(value['mediana'], 2)}** · 3º quartil **{round(value['p75'], 2)}** "
+                                 f"(aprox.) · {stats['count']} alunos com nota")
+                    continue
+                
+                label = {'media': 'média', 'mediana': median_label, 'min': 'mínimo', 'max': 'máximo',
+                         'percentil': f"percentil {intent['percentil']} (aprox.)"}[intent['estatistica']]
+                lines.append(f"- **{disciplina}** ({col}): {label} **{round(value, 2)}** "
+                             f"· {stats['count']} alunos com nota")
         
-        if analysis['total_alunos'] == 0:
-            context += f"📄 {filename}: Nenhum aluno encontrado\n\n"
-            continue
+        if not lines:
+            return None
         
-        context += f"📄 ARQUIVO: {filename}\n"
-        context += f"Tipo: {analysis['tipo']}\n"
-        context += f"Total de alunos: {analysis['total_alunos']}\n\n"
-        
-        # Estatísticas principais
-        if 'media_lp' in analysis:
-            context += f"📊 LÍNGUA PORTUGUESA:\n"
-            context += f"  - Média: {analysis['media_lp']}\n"
-            context += f"  - Mínimo: {analysis['min_lp']}\n"
-            context += f"  - Máximo: {analysis['max_lp']}\n\n"
-        
-        if 'media_mat' in analysis:
-            context += f"📊 MATEMÁTICA:\n"
-            context += f"  - Média: {analysis['media_mat']}\n"
-            context += f"  - Mínimo: {analysis['min_mat']}\n"
-            context += f"  - Máximo: {analysis['max_mat']}\n\n"
-        
-        # Outras métricas
-        if 'numeric_stats' in analysis and analysis['numeric_stats']:
-            outras_metricas = [k for k in analysis['numeric_stats'].keys() 
-                              if k not in ['nota_lp', 'nota_mat']]
-            if outras_metricas:
-                context += f"📊 OUTRAS DISCIPLINAS/MÉTRICAS:\n"
-                for col in outras_metricas[:5]:  # Limita a 5
-                    stats = analysis['numeric_stats'][col]
-                    context += f"  - {col}: média={stats['media']}, min={stats['min']}, max={stats['max']}\n"
-                context += "\n"
-        
-        # Distribuições de níveis
-        if 'level_distributions' in analysis and analysis['level_distributions']:
-            context += f"📈 DISTRIBUIÇÃO DE NÍVEIS (% de alunos):\n"
-            for col, dist in analysis['level_distributions'].items():
-                context += f"  {col}:\n"
-                for nivel, percent in sorted(dist.items(), key=lambda x: -x[1])[:3]:
-                    context += f"    - {nivel}: {percent}%\n"
-            context += "\n"
-        
-        # Informações de agrupamento
-        if 'series' in analysis:
-            series_info = [f"{k} ({v} alunos)" for k, v in list(analysis['series'].items())[:5]]
-            context += f"📚 Séries/Anos: {', '.join(series_info)}\n"
-        
-        if 'turmas' in analysis:
-            turmas_info = [f"{k} ({v} alunos)" for k, v in list(analysis['turmas'].items())[:5]]
-            context += f"🏫 Turmas: {', '.join(turmas_info)}\n"
-        
-        if 'num_escolas' in analysis and analysis['num_escolas'] > 1:
-            context += f"🏢 Total de escolas: {analysis['num_escolas']}\n"
-            if 'nomes_escolas' in analysis:
-                context += f"   Exemplos: {', '.join(analysis['nomes_escolas'][:3])}\n"
-        
-        # Amostra dos dados
-        context += f"\n📋 AMOSTRA DOS DADOS (3 primeiras linhas):\n"
-        sample = df.head(3).to_string(max_cols=10)
-        context += sample + "\n"
-        
-        context += "\n" + "="*70 + "\n\n"
+        filtros = ', '.join(view['filters_applied']) or 'nenhum (todos os alunos)'
+        return {
+            'text': (f"⚡ **Resposta direta** (calculada dos dados carregados)\n\n"
+                     f"📄 Arquivo: {filename}  \n🎯 Filtros: {filtros}\n\n" + "\n".join(lines)),
+            'filename': filename,
+            'filters_applied': view['filters_applied']
+        }
     
-    return context
-
-def get_focus_instructions(focus_type):
-    """Retorna instruções específicas para cada foco"""
-    instructions = {
-        "Equipe Gestora": """
-VOCÊ É UM ESPECIALISTA EM GESTÃO EDUCACIONAL. 
-Analise os dados sob perspectiva estratégica:
-- Identifique padrões e tendências nos resultados REAIS dos dados
-- Use NÚMEROS ESPECÍFICOS dos dados fornecidos
-- Foque em métricas agregadas (por escola, turma, disciplina)
-- Proponha planos de ação com metas SMART
-- Sugira intervenções sistêmicas
-- Inclua indicadores de acompanhamento
-- Seja específico, acionável e baseado em DADOS
-""",
-        "Professores": """
-VOCÊ É UM PROFESSOR ESPECIALISTA EM METODOLOGIAS ATIVAS.
-Crie conteúdo prático e engajador:
-- Analise as DIFICULDADES ESPECÍFICAS identificadas nos dados
-- Desenvolva planos de aula de 50 minutos
-- Use metodologias lúdicas e gamificadas
-- Inclua: objetivos claros, materiais, desenvolvimento passo a passo, avaliação
-- Use jogos, desafios, trabalho em grupo
-- Relacione com cotidiano dos alunos
-- Seja CRIATIVO, DIVERTIDO e baseado nas necessidades REAIS dos alunos
-- Utilize as técnicas de Doug Lemov e Princípios de Rosenshine
-""",
-        "Professores Especialistas": """
-VOCÊ É UM FORMADOR DE PROFESSORES.
-Desenvolva conteúdo de formação continuada:
-- Analise as DEFASAGENS ESPECÍFICAS identificadas nos dados
-- Apresente boas práticas pedagógicas baseadas em evidências
-- Sugira atividades "mão na massa" para os professores aplicarem
-- Inclua exemplos práticos e estudos de caso
-- Proponha oficinas e workshops estruturados
-- Forneça materiais de apoio concretos
-- Foque em habilidades BNCC que estão em defasagem
-- Seja PRÁTICO e focado em APLICAÇÃO IMEDIATA
-"""}
+    return None
+
+def route_question(user_message, filters, edition_year=None):
+    """Decide entre resposta direta e Gemini; registra a decisão para medir chamadas economizadas"""
+    intent = detect_quantitative_intent(user_message)
+    answer = answer_quantitative_question(intent, filters, edition_year) if intent else None
     
-    return instructions.get(focus_type, instructions["Equipe Gestora"])
+    route = 'direta' if answer else 'gemini'
+    stats = st.session_state.routing_stats
+    stats[route] += 1
+    logger.info(
+        "roteamento=%s intencao=%s filtros=%s respostas_diretas=%d chamadas_gemini=%d",
+        route, intent['tipo'] if intent else 'aberta', sorted(filters), stats['direta'], stats['gemini']
+    )
+    return answer
 
 def chat_with_agent(user_message):
     """Processa mensagem do usuário e retorna resposta do agente"""
@@ -474,39 +637,60 @@ def chat_with_agent(user_message):
             return "Erro: Modelo Gemini não inicializado"
         
         # Verifica se há dados carregados
-        if not st.session_state.dataframes:
+        if not st.session_state.dataframes and not st.session_state.shard_manifest:
             return "⚠️ Por favor, carregue os dados SARESP primeiro na barra lateral."
         
-        # Extrai filtros do prompt
-        filters = extract_filters_from_prompt(user_message)
-        
-        # Tenta aplicar filtros em todos os DataFrames
-        filtered_data = None
-        filters_applied = []
+        with timed_stage('filtros'):
+            # Extrai filtros do prompt
+            filters = extract_filters_from_prompt(user_message)
+            edition_year = extract_edition_year(user_message, filters)
+            
+            # Escolas citadas são carregadas dos shards pré-processados
+            if 'codigo_escola' in filters:
+                load_school_shards(filters['codigo_escola'])
         
-        if filters:
-            for filename, info in st.session_state.dataframes.items():
-                df = info['df']
-                filtered_df, applied = apply_filters_to_dataframe(df, filters)
-                
-                if filtered_df is not None and not filtered_df.empty:
-                    filtered_data = {
-                        'df': filtered_df,
-                        'filename': filename,
-                        'filters': applied
-                    }
-                    filters_applied = applied
-                    break  # Usa o primeiro DataFrame que teve filtros aplicados com sucesso
-        
-        # Cria contexto
-        if filtered_data:
-            data_context = create_data_context(filtered_df_info=filtered_data)
-            st.session_state.last_filters = filters_applied
-        else:
-            data_context = create_data_context()
-            st.session_state.last_filters = None
+        # Perguntas puramente quantitativas são respondidas direto dos agregados
+        with timed_stage('roteamento'):
+            direct_answer = route_question(user_message, filters, edition_year)
+        if direct_answer:
+            st.session_state.last_filters = direct_answer['filters_applied'] or None
+            st.session_state.export_view = {
+                'filename': direct_answer['filename'],
+                'filters': filters,
+                'filters_applied': direct_answer['filters_applied']
+            } if direct_answer['filters_applied'] else None
+            return direct_answer['text']
         
-        focus_instructions = get_focus_instructions(st.session_state.focus)
+        with timed_stage('contexto'):
+            # Tenta aplicar filtros em todos os DataFrames
+            filtered_data = None
+            filters_applied = []
+            
+            if filters:
+                for filename, info in entries_by_edition(edition_year) or entries_by_edition():
+                    filtered_data = filter_dataset_entry(info, filename, filters)
+                    if filtered_data:
+                        filters_applied = filtered_data['filters']
+                        break  # Usa o primeiro DataFrame que teve filtros aplicados com sucesso
+            
+            # Cria contexto
+            if filtered_data:
+                data_context = create_data_context(filtered_df_info=filtered_data)
+                st.session_state.last_filters = filters_applied
+                st.session_state.export_view = {'filename': filename, 'filters': filters, 'filters_applied': filters_applied}
+            else:
+                data_context = create_data_context(dataframes=st.session_state.dataframes,
+                                                   manifest=st.session_state.shard_manifest)
+                st.session_state.last_filters = None
+                st.session_state.export_view = None
+            
+            if edition_year is not None and not entries_by_edition(edition_year):
+                data_context += (f"⚠️ EDIÇÃO {edition_year} NÃO CARREGADA: os dados acima são de outra edição; "
+                                 f"informe isso ao usuário antes de responder.\n\n")
+            
+            # Evolução entre edições sai da tabela longitudinal pré-calculada
+            if st.session_state.longitudinal and is_longitudinal_request(user_message):
+                data_context += format_longitudinal_context(st.session_state.longitudinal, filters)
         
         # Histórico recente
         history_context = ""
@@ -517,74 +701,116 @@ def chat_with_agent(user_message):
                 history_context += f"{role}: {msg['content'][:200]}...\n"
         
         # Monta prompt completo
-        full_prompt = f"""
-{focus_instructions}
-
-{data_context}
-
-{history_context}
-
-=== FOCO SELECIONADO ===
-{st.session_state.focus}
-
-=== PERGUNTA DO USUÁRIO ===
-{user_message}
-
-=== INSTRUÇÕES CRÍTICAS ===
-1. Analise CUIDADOSAMENTE os dados fornecidos acima
-2. Use NÚMEROS e ESTATÍSTICAS REAIS dos dados
-3. Se filtros foram aplicados, foque APENAS nos dados filtrados
-4. Seja ESPECÍFICO e PRÁTICO
-5. Formate bem a resposta com títulos e seções claras usando markdown
-6. Use bullet points quando apropriado
-7. Se pedirem visualização, descreva qual tipo seria útil
-8. Se pedirem plano de aula: estruture em 4 momentos de 50 minutos total
-9. Se pedirem plano de ação: inclua diagnóstico, objetivos SMART, ações, cronograma
-10. Se pedirem formação: inclua módulos, oficinas práticas, boas práticas
-
-RESPONDA AGORA DE FORMA COMPLETA E ESTRUTURADA:
-"""
+        full_prompt = build_agent_prompt(user_message, data_context, st.session_state.focus, history_context)
         
         # Chama o Gemini
-        response = model.generate_content(full_prompt)
+        with timed_stage('gemini'):
+            response = model.generate_content(full_prompt)
         
         return response.text
         
     except Exception as e:
         return f"❌ Erro ao processar: {str(e)}\n\nTente novamente ou reformule sua pergunta."
 
-def create_chart_from_request(prompt, filtered_df=None):
+def create_chart_from_request(prompt, filtered_df=None, cube_view=None, source_entry=None, store_view=None):
     """Cria visualização baseada em solicitação"""
     try:
-        # Decide qual DataFrame usar
+        # Evolução entre edições: linhas da escola (ou da rede) por ano, da tabela longitudinal
+        longitudinal = st.session_state.longitudinal
+        if longitudinal and is_longitudinal_request(prompt):
+            fig = create_evolution_chart(longitudinal, extract_filters_from_prompt(prompt))
+            if fig is not None:
+                return fig
+        
+        # Decide qual fonte usar: DataFrame filtrado, visão do cubo, visão do banco ou primeiro arquivo
         if filtered_df is not None and not filtered_df.empty:
-            df = filtered_df
+            source_entry = None
+            cube_view = None
+            store_view = None
+            title_prefix = "DADOS FILTRADOS"
+        elif cube_view is not None and source_entry is not None:
+            store_view = None
+            title_prefix = "DADOS FILTRADOS"
+        elif store_view is not None:
+            source_entry = None
+            cube_view = None
             title_prefix = "DADOS FILTRADOS"
         elif st.session_state.dataframes:
-            # Usa o primeiro dataframe disponível
-            df = list(st.session_state.dataframes.values())[0]['df']
+            # Usa o primeiro dataframe disponível (edição mais recente no modo longitudinal)
+            edition_year = extract_edition_year(prompt, extract_filters_from_prompt(prompt))
+            source_entry = (entries_by_edition(edition_year) or entries_by_edition())[0][1]
+            if source_entry.get('store'):
+                # Arquivo no banco: agregações em SQL, sem trazer a tabela para a sessão
+                store_view = full_store_view(source_entry)
+                source_entry = None
+            else:
+                cube_view = full_cube_view(source_entry.get('cube'))
             title_prefix = "VISÃO GERAL"
         else:
             return None
         
+        def raw_rows(needed=None):
+            """Linhas de alunos, materializadas só para gráficos que precisam dos valores brutos"""
+            if store_view is not None:
+                # Só as colunas do gráfico, lidas para esta resposta (não ficam na sessão)
+                return read_store_rows(store_view, columns=needed)
+            if source_entry is None:
+                return filtered_df
+            source_df = get_entry_df(source_entry)
+            if cube_view is not None and cube_view['filters']:
+                rows, _ = apply_filters_to_dataframe(source_df, cube_view['filters'])
+                return rows if rows is not None else source_df.iloc[0:0]
+            return source_df
+        
+        if cube_view is not None:
+            columns = cube_view['cube']['columns']
+        elif store_view is not None:
+            columns = store_view['info']['analysis']['colunas']
+        else:
+            columns = list(raw_rows().columns)
+        cube_dims = cube_view['cube']['dims'] if cube_view is not None else []
+        cube_metrics = cube_view['cube']['metrics'] if cube_view is not None else []
+        
+        def group_means(by):
+            """Médias de LP e MAT por dimensão, pelo cubo ou pelo banco quando disponíveis"""
+            if by in cube_dims and 'nota_lp' in cube_metrics and 'nota_mat' in cube_metrics:
+                return cube_group_means(cube_view, by, ['nota_lp', 'nota_mat'])
+            if store_view is not None:
+                return store_group_means(store_view, by, ['nota_lp', 'nota_mat'])
+            return raw_rows().groupby(by)[['nota_lp', 'nota_mat']].mean().reset_index()
+        
         prompt_lower = prompt.lower()
         
         # 1. Distribuição de notas
         if any(word in prompt_lower for word in ['distribuição', 'histograma']):
-            if 'nota_lp' in df.columns and 'nota_mat' in df.columns:
+            if 'nota_lp' in columns and 'nota_mat' in columns:
+                view_sketches = select_view_sketches(source_entry, cube_view) if source_entry else None
                 fig = go.Figure()
-                fig.add_trace(go.Histogram(
-                    x=df['nota_lp'].dropna(), 
-                    name='Língua Portuguesa', 
-                    opacity=0.7,
-                    nbinsx=20
-                ))
-                fig.add_trace(go.Histogram(
-                    x=df['nota_mat'].dropna(), 
-                    name='Matemática', 
-                    opacity=0.7,
-                    nbinsx=20
-                ))
+                if view_sketches and 'nota_lp' in view_sketches and 'nota_mat' in view_sketches:
+                    # Histograma reconstruído dos sketches, sem ler as notas dos alunos
+                    for col, name in [('nota_lp', 'Língua Portuguesa'), ('nota_mat', 'Matemática')]:
+                        edges, counts = sketch_histogram(view_sketches[col], nbins=20)
+                        fig.add_trace(go.Bar(
+                            x=(edges[:-1] + edges[1:]) / 2,
+                            y=counts,
+                            width=np.diff(edges),
+                            name=name,
+                            opacity=0.7
+                        ))
+                else:
+                    df = raw_rows(['nota_lp', 'nota_mat'])
+                    fig.add_trace(go.Histogram(
+                        x=df['nota_lp'].dropna(), 
+                        name='Língua Portuguesa', 
+                        opacity=0.7,
+                        nbinsx=20
+                    ))
+                    fig.add_trace(go.Histogram(
+                        x=df['nota_mat'].dropna(), 
+                        name='Matemática', 
+                        opacity=0.7,
+                        nbinsx=20
+                    ))
                 fig.update_layout(
                     title=f'{title_prefix} - Distribuição de Notas',
                     xaxis_title='Nota',
@@ -597,8 +823,8 @@ def create_chart_from_request(prompt, filtered_df=None):
         
         # 2. Comparação por gênero
         if any(word in prompt_lower for word in ['gênero', 'genero', 'sexo', 'feminino', 'masculino']):
-            if 'sexo' in df.columns and 'nota_lp' in df.columns:
-                dados_genero = df.groupby('sexo')[['nota_lp', 'nota_mat']].mean().reset_index()
+            if 'sexo' in columns and 'nota_lp' in columns:
+                dados_genero = group_means('sexo')
                 fig = go.Figure()
                 fig.add_trace(go.Bar(
                     name='Língua Portuguesa',
@@ -621,8 +847,9 @@ def create_chart_from_request(prompt, filtered_df=None):
         
         # 3. Boxplot por disciplina
         if 'boxplot' in prompt_lower or 'dispersão' in prompt_lower:
-            notas_cols = [col for col in df.columns if col.startswith('nota_') and 'original' not in col]
+            notas_cols = [col for col in columns if col.startswith('nota_') and 'original' not in col]
             if len(notas_cols) > 1:
+                df = raw_rows(notas_cols[:6])
                 fig = go.Figure()
                 for col in notas_cols[:6]:
                     disciplina = col.replace('nota_', '').upper()
@@ -637,10 +864,16 @@ def create_chart_from_request(prompt, filtered_df=None):
         
         # 4. Gráfico de pizza para níveis
         if 'pizza' in prompt_lower or 'nível' in prompt_lower or 'nivel' in prompt_lower:
-            nivel_cols = [col for col in df.columns if 'nivel' in col.lower() or 'classific' in col.lower()]
+            nivel_cols = [col for col in columns if 'nivel' in col.lower() or 'classific' in col.lower()]
             if nivel_cols:
                 col = nivel_cols[0]
-                distribution = df[col].value_counts()
+                if cube_view is not None and col in cube_view['cube']['levels']:
+                    distribution = cube_level_counts(cube_view, col)
+                elif store_view is not None:
+                    with store_connection(store_view['info']['store']['path']) as conn:
+                        distribution = pd.Series(store_value_counts(conn, store_view, col))
+                else:
+                    distribution = raw_rows([col])[col].value_counts()
                 fig = px.pie(
                     values=distribution.values,
                     names=distribution.index,
@@ -651,8 +884,8 @@ def create_chart_from_request(prompt, filtered_df=None):
         
         # 5. Comparação por turma
         if 'turma' in prompt_lower:
-            if 'turma' in df.columns and 'nota_lp' in df.columns:
-                dados_turma = df.groupby('turma')[['nota_lp', 'nota_mat']].mean().reset_index()
+            if 'turma' in columns and 'nota_lp' in columns:
+                dados_turma = group_means('turma')
                 fig = go.Figure()
                 fig.add_trace(go.Bar(name='LP', x=dados_turma['turma'], y=dados_turma['nota_lp']))
                 fig.add_trace(go.Bar(name='MAT', x=dados_turma['turma'], y=dados_turma['nota_mat']))
@@ -668,8 +901,8 @@ def create_chart_from_request(prompt, filtered_df=None):
         
         # 6. Comparação por série
         if 'série' in prompt_lower or 'serie' in prompt_lower:
-            if 'serie_ano' in df.columns and 'nota_lp' in df.columns:
-                dados_serie = df.groupby('serie_ano')[['nota_lp', 'nota_mat']].mean().reset_index()
+            if 'serie_ano' in columns and 'nota_lp' in columns:
+                dados_serie = group_means('serie_ano')
                 fig = go.Figure()
                 fig.add_trace(go.Bar(name='LP', x=dados_serie['serie_ano'], y=dados_serie['nota_lp']))
                 fig.add_trace(go.Bar(name='MAT', x=dados_serie['serie_ano'], y=dados_serie['nota_mat']))
@@ -684,8 +917,9 @@ def create_chart_from_request(prompt, filtered_df=None):
                 return fig
         
         # Fallback: boxplot geral
-        numeric_cols = [col for col in df.columns if col.startswith('nota_') and 'original' not in col]
+        numeric_cols = [col for col in columns if col.startswith('nota_') and 'original' not in col]
         if numeric_cols:
+            df = raw_rows(numeric_cols[:6])
             fig = go.Figure()
             for col in numeric_cols[:6]:
                 fig.add_trace(go.Box(y=df[col].dropna(), name=col.replace('nota_', '')))
@@ -703,6 +937,75 @@ def create_chart_from_request(prompt, filtered_df=None):
         st.error(f"Erro ao criar visualização: {e}")
         return None
 
+def create_evolution_chart(longitudinal, filters):
+    """Gráfico de linhas das médias de LP e MAT por edição, com a rede tracejada para comparação"""
+    years = longitudinal['anos']
+    evolution = None
+    if 'codigo_escola' in filters:
+        evolution = lookup_school_evolution(longitudinal, filters['codigo_escola'], filters.get('serie_ano'))
+    if evolution:
+        serie, serie_result = next(iter(evolution['series'].items()))
+    
+    fig = go.Figure()
+    for disciplina, (_, columns) in SUBJECT_METRICS.items():
+        col = next((c for c in columns if c in longitudinal['metrics']), None)
+        if col is None:
+            continue
+        rede = [longitudinal['rede'][year].get(col) for year in years]
+        if evolution:
+            stats = serie_result['disciplinas'].get(col)
+            if stats:
+                fig.add_trace(go.Scatter(x=list(stats['medias']), y=list(stats['medias'].values()),
+                                         mode='lines+markers', name=f"{disciplina} (escola)"))
+            fig.add_trace(go.Scatter(x=years, y=rede, mode='lines', name=f"{disciplina} (rede)", line={'dash': 'dash'}))
+        else:
+            fig.add_trace(go.Scatter(x=years, y=rede, mode='lines+markers', name=disciplina))
+    if not fig.data:
+        return None
+    
+    if evolution:
+        title = f"Escola {evolution['codigo_escola']} - Evolução das Médias"
+        if serie != LONGITUDINAL_ALL_SERIES:
+            title += f" ({serie})"
+    else:
+        title = 'REDE - Evolução das Médias'
+    fig.update_layout(
+        title=title,
+        xaxis_title='Edição',
+        yaxis_title='Média',
+        xaxis={'tickmode': 'array', 'tickvals': years},
+        template='plotly_white',
+        height=450
+    )
+    return fig
+
+def render_export_section():
+    """Download dos alunos do recorte atual (arquivo gerado em segundo plano)"""
+    export_view = st.session_state.export_view
+    if export_view and export_view['filename'] in st.session_state.dataframes:
+        st.markdown("### 📥 Exportar Alunos do Recorte")
+        export_format = st.selectbox("Formato", list(EXPORT_FORMATS), key='export_format')
+        job = st.session_state.export_job
+        if st.button("Gerar arquivo", use_container_width=True, disabled=bool(job and job['status'] == 'gerando')):
+            start_export(export_view, EXPORT_FORMATS[export_format])
+            job = st.session_state.export_job
+    else:
+        job = st.session_state.export_job
+    
+    if job:
+        if job['status'] == 'gerando':
+            st.progress(job['linhas'] / max(job['total'], 1),
+                        text=f"Gerando... {job['linhas']:,} de {job['total']:,} alunos".replace(',', '.'))
+            st.button("🔄 Atualizar", use_container_width=True)
+        elif job['status'] == 'pronto' and os.path.exists(job['path']):
+            total = f"{job['total']:,}".replace(',', '.')
+            st.caption(f"{', '.join(job['filtros'])} · {total} alunos · {format_bytes(os.path.getsize(job['path']))}")
+            with open(job['path'], 'rb') as f:
+                st.download_button(f"⬇️ Baixar {job['nome']}", f, file_name=job['nome'],
+                                   mime=EXPORT_MIME_TYPES[job['formato']], use_container_width=True)
+        elif job['status'] == 'erro':
+            st.error(f"Erro ao exportar: {job['erro']}")
+
 def main():
     st.title("🎓 Agente Inteligente SARESP")
     st.markdown("*Análise Educacional com Google Gemini 2.5 Pro*")
@@ -750,11 +1053,16 @@ def main():
                     if file.name not in st.session_state.dataframes:
                         df, text = load_data_file(file)
                         if df is not None:
-                            analysis = analyze_dataframe(df, file.name)
-                            st.session_state.dataframes[file.name] = {
-                                'df': df,
-                                'analysis': analysis
-                            }
+                            entry = build_dataset_entry(df, file.name)
+                            if SQLITE_STORE_PATH:
+                                # Com banco compartilhado, a sessão guarda só a análise; os alunos ficam no SQLite
+                                try:
+                                    save_to_store(SQLITE_STORE_PATH, file.name, df, entry['analysis'], entry['ranking'])
+                                    attach_store_entries(SQLITE_STORE_PATH)
+                                except sqlite3.Error as e:
+                                    st.error(f"Erro ao gravar {file.name} no banco: {e}")
+                            else:
+                                st.session_state.dataframes[file.name] = entry
             
             # Mostra arquivos carregados
             st.success(f"✅ {len(st.session_state.dataframes)} arquivo(s) carregado(s)")
@@ -777,8 +1085,66 @@ def main():
                         if info['analysis']['num_escolas'] <= 5:
                             st.write("**Códigos:**", ", ".join(map(str, info['analysis'].get('cods_escolas', []))))
         
+        # Memória da sessão: despeja em disco os arquivos menos usados acima do orçamento
+        if st.session_state.dataframes:
+            enforce_memory_budget()
+            usage = get_memory_usage()
+            st.markdown("### 💾 Memória")
+            st.caption(
+                f"Sessão: {format_bytes(usage['session_resident'])} residente · "
+                f"{format_bytes(usage['session_spilled'])} em disco "
+                f"(limite {SESSION_MEMORY_BUDGET_MB:.0f} MB)  \n"
+                f"Processo: {format_bytes(usage['process_resident'])} de {PROCESS_MEMORY_BUDGET_MB:.0f} MB"
+            )
+        
+        # Banco compartilhado entre os processos do app (SARESP_SQLITE_PATH)
+        if SQLITE_STORE_PATH:
+            st.markdown("### 🗄️ Banco Compartilhado")
+            if not st.session_state.store_attached or st.button("🔄 Atualizar do banco", use_container_width=True):
+                try:
+                    attach_store_entries(SQLITE_STORE_PATH)
+                except sqlite3.Error as e:
+                    st.error(f"Erro ao abrir o banco: {e}")
+                st.session_state.store_attached = True
+            stored = [name for name, info in st.session_state.dataframes.items() if info.get('store')]
+            st.caption(f"{len(stored)} arquivo(s) em {SQLITE_STORE_PATH}")
+        
+        # Modo longitudinal: recalculado só quando muda o conjunto de edições carregadas
+        longitudinal = refresh_longitudinal()
+        if longitudinal:
+            st.markdown("### 📈 Evolução entre Edições")
+            st.caption(
+                f"Edições {', '.join(map(str, longitudinal['anos']))} · "
+                f"{longitudinal['escolas_todas_edicoes']} de {longitudinal['escolas']} escolas em todas  \n"
+                "Pergunte pela \"evolução da escola ...\" no chat"
+            )
+        
+        # Dados pré-processados (gerados por precompute.py)
+        st.markdown("### 📦 Dados Pré-processados")
+        manifest_path = st.text_input(
+            "Manifesto",
+            value=os.getenv("SARESP_MANIFEST", ""),
+            placeholder="dados_preprocessados/manifest.json"
+        )
+        if manifest_path and st.button("📂 Abrir manifesto", use_container_width=True):
+            try:
+                st.session_state.shard_manifest = load_shard_manifest(manifest_path)
+            except (OSError, ValueError, KeyError) as e:
+                st.error(f"Erro ao abrir manifesto: {e}")
+        
+        if st.session_state.shard_manifest:
+            manifest = st.session_state.shard_manifest
+            total_escolas = len({key for file_info in manifest['arquivos'].values() for key in file_info['escolas']})
+            st.success(f"✅ {len(manifest['arquivos'])} arquivo(s), {total_escolas} escola(s) disponíveis")
+            st.caption("Cite o código da escola no chat para carregar seus dados")
+        
         st.markdown("---")
         
+        # Perguntas respondidas sem chamar o Gemini
+        routing = st.session_state.routing_stats
+        if routing['direta']:
+            st.caption(f"⚡ Respostas diretas: {routing['direta']} de {routing['direta'] + routing['gemini']} perguntas")
+        
         # Mostra filtros ativos
         if st.session_state.last_filters:
             st.markdown("### 🎯 Filtros Ativos")
@@ -786,11 +1152,20 @@ def main():
                 st.markdown(f'<div class="filter-badge">{filter_text}</div>', unsafe_allow_html=True)
             st.markdown("---")
         
-        if st.session_state.dataframes:
+        # Exportação do recorte: preenchida no fim do script, depois que o chat define os filtros
+        export_container = st.container()
+        
+        if st.session_state.dataframes or st.session_state.shard_manifest:
             if st.button("🗑️ Limpar Tudo", use_container_width=True):
                 st.session_state.dataframes = {}
                 st.session_state.messages = []
                 st.session_state.last_filters = None
+                st.session_state.shard_manifest = None
+                st.session_state.export_view = None
+                st.session_state.export_job = None
+                st.session_state.longitudinal = None
+                st.session_state.longitudinal_key = None
+                release_session_memory()
                 st.rerun()
         
         # Instruções
@@ -814,12 +1189,13 @@ O agente detecta automaticamente:
 - "Compare gêneros do 7º ano"
 - "Plano de ação para código 901748"
 - "Gráfico da escola 5162"
+- "Evolução da escola 5174 entre as edições"
             """)
     
     # === ÁREA PRINCIPAL - CHAT ===
     
     # Mensagem de boas-vindas
-    if not st.session_state.dataframes:
+    if not st.session_state.dataframes and not st.session_state.shard_manifest:
         st.info("👈 Comece fazendo upload dos arquivos SARESP na barra lateral")
         
         col1, col2, col3 = st.columns(3)
@@ -859,22 +1235,38 @@ O agente detecta automaticamente:
                 
                 # Verifica se deve criar visualização
                 chart = None
-                if any(word in prompt.lower() for word in ['gráfico', 'visualização', 'visualizar', 'mostrar', 'plotar', 'distribuição', 'comparação', 'boxplot', 'pizza']):
-                    # Se há filtros aplicados, usa dados filtrados
-                    filtered_df = None
-                    if st.session_state.last_filters:
-                        # Tenta obter DataFrame filtrado
-                        filters = extract_filters_from_prompt(prompt)
-                        if filters:
-                            for filename, info in st.session_state.dataframes.items():
-                                df = info['df']
-                                filtered_df, _ = apply_filters_to_dataframe(df, filters)
-                                if filtered_df is not None:
-                                    break
+                if any(word in prompt.lower() for word in ['gráfico', 'visualização', 'visualizar', 'mostrar', 'plotar', 'distribuição', 'comparação', 'boxplot', 'pizza']) or \
+                        (st.session_state.longitudinal and is_longitudinal_request(prompt)):
+                    with timed_stage('grafico'):
+                        # Se há filtros aplicados, usa dados filtrados
+                        filtered_df = None
+                        chart_view = None
+                        chart_source = None
+                        chart_store_view = None
+                        if st.session_state.last_filters:
+                            # Tenta obter visão filtrada (cubo) ou DataFrame filtrado
+                            filters = extract_filters_from_prompt(prompt)
+                            if filters:
+                                edition_year = extract_edition_year(prompt, filters)
+                                for filename, info in entries_by_edition(edition_year) or entries_by_edition():
+                                    if info.get('store'):
+                                        chart_store_view = query_store(info, filters)
+                                        if chart_store_view is not None:
+                                            break
+                                        continue
+                                    if info.get('cube') is not None:
+                                        chart_view = query_cube(info['cube'], filters)
+                                        if chart_view is not None:
+                                            chart_source = info
+                                            break
+                                        continue
+                                    filtered_df, _ = apply_filters_to_dataframe(get_entry_df(info), filters)
+                                    if filtered_df is not None:
+                                        break
                     
-                    chart = create_chart_from_request(prompt, filtered_df)
-                    if chart:
-                        st.plotly_chart(chart, use_container_width=True)
+                        chart = create_chart_from_request(prompt, filtered_df, chart_view, chart_source, chart_store_view)
+                        if chart:
+                            st.plotly_chart(chart, use_container_width=True)
                 
                 # Salva resposta
                 st.session_state.messages.append({
@@ -882,6 +1274,13 @@ O agente detecta automaticamente:
                     "content": response,
                     "chart": chart
                 })
+                
+                # Arquivos trazidos do disco durante a resposta voltam a respeitar o orçamento
+                with timed_stage('memoria'):
+                    enforce_memory_budget()
+    
+    with export_container:
+        render_export_section()
     
     # Sugestões rápidas
     if len(st.session_state.messages) == 0:
@@ -893,6 +1292,11 @@ O agente detecta automaticamente:
             first_df = list(st.session_state.dataframes.values())[0]
             if 'cods_escolas' in first_df['analysis'] and first_df['analysis']['cods_escolas']:
                 exemplo_codigo = str(first_df['analysis']['cods_escolas'][0])
+        elif st.session_state.shard_manifest:
+            for file_info in st.session_state.shard_manifest['arquivos'].values():
+                if file_info['escolas']:
+                    exemplo_codigo = next(iter(file_info['escolas']))
+                    break
         
         suggestions = {
             "Equipe Gestora": [
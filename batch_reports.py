@@ -0,0 +1,245 @@
+"""
+Geração em lote de relatórios por escola.
+
+Para cada código de escola, monta o contexto filtrado (como no chat), envia o
+pedido ao Gemini com o foco escolhido e grava um arquivo Markdown por escola.
+As chamadas ao Gemini rodam em paralelo com limite de concorrência e o
+progresso fica em checkpoint.json: rodar o mesmo comando de novo retoma a
+partir das escolas que faltam.
+
+Uso:
+    python batch_reports.py --escolas 5174 5162 901748 --dados microdados_2023_efaf.csv \\
+        --foco "Equipe Gestora" --saida relatorios
+    python batch_reports.py --arquivo-escolas escolas.txt --manifesto dados_preprocessados/manifest.json
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+
+from saresp_core import (
+    build_agent_prompt,
+    build_dataset_entry,
+    create_data_context,
+    create_gemini_model,
+    filter_dataset_entry,
+    get_api_key,
+    load_manifest_ranking,
+    load_shard_manifest,
+    read_data_file,
+    school_key,
+)
+
+FOCOS = ["Equipe Gestora", "Professores", "Professores Especialistas"]
+PEDIDO_PADRAO = "Crie um plano de ação para a escola com diagnóstico, objetivos SMART, ações e cronograma"
+CHECKPOINT_NAME = 'checkpoint.json'
+
+def parse_school_codes(codes, codes_file):
+    """Lê os códigos de escola da linha de comando e/ou de um arquivo (um por linha)"""
+    all_codes = list(codes or [])
+    if codes_file:
+        with open(codes_file, encoding='utf-8') as f:
+            all_codes.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+
+    # Remove duplicados mantendo a ordem
+    return list(dict.fromkeys(school_key(code) for code in all_codes))
+
+def filter_value(code):
+    """Converte o código para o tipo usado pelos filtros do chat (inteiro quando numérico)"""
+    return int(code) if code.isdigit() else code
+
+class DataSource:
+    """Fornece o contexto filtrado de cada escola a partir de arquivos brutos ou do manifesto"""
+
+    def __init__(self, data_files=None, manifest_path=None):
+        self.entries = {}
+        self.manifest = load_shard_manifest(manifest_path) if manifest_path else None
+
+        for path in data_files or []:
+            with open(path, 'rb') as file:
+                df, _ = read_data_file(file)
+            if df is None:
+                raise ValueError(f"formato não suportado: {path}")
+            filename = os.path.basename(path)
+            self.entries[filename] = build_dataset_entry(df, filename)
+
+    def school_entries(self, code):
+        """Retorna os arquivos (já carregados ou shards do manifesto) que podem conter a escola"""
+        entries = dict(self.entries)
+        if self.manifest:
+            for filename, file_info in self.manifest['arquivos'].items():
+                school = file_info['escolas'].get(code)
+                if school:
+                    df = pd.read_parquet(os.path.join(self.manifest['base_dir'], school['shard']))
+                    entries[filename] = build_dataset_entry(df, filename)
+                    entries[filename]['ranking'] = load_manifest_ranking(self.manifest, filename)
+        return entries
+
+    def build_context(self, code):
+        """Monta o contexto de dados da escola em todos os arquivos onde ela aparece"""
+        filters = {'codigo_escola': filter_value(code)}
+        contexts = []
+        for filename, info in self.school_entries(code).items():
+            filtered_data = filter_dataset_entry(info, filename, filters)
+            if filtered_data:
+                contexts.append(create_data_context(filtered_df_info=filtered_data))
+        return "\n".join(contexts)
+
+class Checkpoint:
+    """Progresso do lote gravado em disco a cada escola concluída"""
+
+    def __init__(self, output_dir, focus, request):
+        self.path = os.path.join(output_dir, CHECKPOINT_NAME)
+        self.lock = threading.Lock()
+        self.state = {'foco': focus, 'pedido': request, 'concluidas': {}, 'falhas': {}}
+
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get('foco') != focus or saved.get('pedido') != request:
+                raise ValueError(
+                    f"{self.path} pertence a outro lote (foco/pedido diferentes); "
+                    "use outra pasta de saída ou --reiniciar"
+                )
+            self.state = saved
+            self.state['falhas'] = {}
+
+    def is_done(self, code, output_dir):
+        """Escola já concluída e com o relatório presente em disco"""
+        done = self.state['concluidas'].get(code)
+        return bool(done) and os.path.exists(os.path.join(output_dir, done['arquivo']))
+
+    def mark(self, code, report_file=None, error=None):
+        """Registra conclusão ou falha de uma escola e grava o checkpoint"""
+        with self.lock:
+            if error is None:
+                self.state['concluidas'][code] = {
+                    'arquivo': report_file,
+                    'concluido_em': datetime.now().isoformat(timespec='seconds')
+                }
+                self.state['falhas'].pop(code, None)
+            else:
+                self.state['falhas'][code] = error
+
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+
+def generate_with_retry(model, prompt, attempts=3):
+    """Chama o Gemini com novas tentativas e espera exponencial (limites de taxa, falhas de rede)"""
+    for attempt in range(attempts):
+        try:
+            return model.generate_content(prompt).text
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+def write_report(output_dir, code, focus, request, text):
+    """Grava o relatório Markdown da escola e retorna o nome do arquivo"""
+    report_file = f"escola_{code}.md"
+    header = (
+        f"# Relatório — Escola {code}\n\n"
+        f"**Foco:** {focus}  \n"
+        f"**Pedido:** {request}  \n"
+        f"**Gerado em:** {datetime.now().strftime('%d/%m/%Y %H:%M')}\n\n---\n\n"
+    )
+    tmp_path = os.path.join(output_dir, report_file + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(header + text + "\n")
+    os.replace(tmp_path, os.path.join(output_dir, report_file))
+    return report_file
+
+def process_school(code, source, model, focus, request, output_dir):
+    """Monta o contexto, gera o relatório de uma escola e grava o Markdown"""
+    data_context = source.build_context(code)
+    if not data_context:
+        raise ValueError("escola não encontrada nos dados")
+
+    prompt = build_agent_prompt(f"{request} (código da escola {code})", data_context, focus)
+    text = generate_with_retry(model, prompt)
+    return write_report(output_dir, code, focus, request, text)
+
+def run_batch(codes, source, model, focus, request, output_dir, concurrency=4):
+    """Processa as escolas pendentes com no máximo `concurrency` chamadas simultâneas ao Gemini"""
+    checkpoint = Checkpoint(output_dir, focus, request)
+    pending = [code for code in codes if not checkpoint.is_done(code, output_dir)]
+    skipped = len(codes) - len(pending)
+    if skipped:
+        print(f"↩️ Retomando: {skipped} escola(s) já concluída(s)")
+
+    start = time.monotonic()
+    done = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(process_school, code, source, model, focus, request, output_dir): code
+            for code in pending
+        }
+        for future in as_completed(futures):
+            code = futures[future]
+            try:
+                report_file = future.result()
+            except Exception as e:
+                checkpoint.mark(code, error=str(e))
+                print(f"  ❌ {code}: {e}")
+                continue
+
+            checkpoint.mark(code, report_file=report_file)
+            done += 1
+            elapsed = time.monotonic() - start
+            print(f"  ✅ {code} ({done}/{len(pending)}, {done / elapsed * 3600:.0f} escolas/hora)")
+
+    return checkpoint.state
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gera relatórios por escola em lote com o Gemini")
+    parser.add_argument('--escolas', nargs='*', help="Códigos das escolas")
+    parser.add_argument('--arquivo-escolas', help="Arquivo texto com um código de escola por linha")
+    parser.add_argument('--dados', nargs='*', help="Arquivos SARESP (CSV, XLSX, XLS)")
+    parser.add_argument('--manifesto', help="manifest.json gerado por precompute.py")
+    parser.add_argument('--foco', default="Equipe Gestora", choices=FOCOS, help="Foco das instruções (padrão: Equipe Gestora)")
+    parser.add_argument('--pedido', default=PEDIDO_PADRAO, help="Pedido enviado para cada escola")
+    parser.add_argument('--saida', default='relatorios', help="Diretório dos relatórios (padrão: relatorios)")
+    parser.add_argument('--concorrencia', type=int, default=4, help="Chamadas simultâneas ao Gemini (padrão: 4)")
+    parser.add_argument('--reiniciar', action='store_true', help="Ignora o checkpoint existente e recomeça o lote")
+    args = parser.parse_args(argv)
+
+    codes = parse_school_codes(args.escolas, args.arquivo_escolas)
+    if not codes:
+        parser.error("informe --escolas ou --arquivo-escolas")
+    if not args.dados and not args.manifesto:
+        parser.error("informe --dados ou --manifesto")
+
+    api_key = get_api_key()
+    if not api_key:
+        print("⚠️ Configure GOOGLE_API_KEY (variável de ambiente ou .streamlit/secrets.toml)")
+        return 1
+
+    os.makedirs(args.saida, exist_ok=True)
+    checkpoint_path = os.path.join(args.saida, CHECKPOINT_NAME)
+    if args.reiniciar and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    print("📂 Carregando dados...")
+    source = DataSource(args.dados, args.manifesto)
+    model = create_gemini_model(api_key)
+
+    print(f"🚀 {len(codes)} escola(s), foco: {args.foco}, concorrência: {args.concorrencia}")
+    try:
+        state = run_batch(codes, source, model, args.foco, args.pedido, args.saida, max(1, args.concorrencia))
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+
+    print(f"\n{len(state['concluidas'])} relatório(s) em {args.saida}, {len(state['falhas'])} falha(s)")
+    return 1 if state['falhas'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,320 @@
+"""
+Teste de carga com sessões simultâneas.
+
+Simula N coordenadores usando o app ao mesmo tempo: cada sessão roda o app
+completo (streamlit.testing), com dados SARESP sintéticos e um Gemini falso
+com latência configurável, e envia uma sequência de perguntas pelo chat
+(chat_with_agent + create_chart_from_request). Ao final mostra latência por
+turno (p50/p95/p99), vazão, pico de memória (RSS) e o tempo gasto em cada
+etapa, e grava tudo em JSON para comparar execuções entre versões.
+
+Uso:
+    python loadtest.py --sessoes 8 --turnos 6 --latencia 2.0 --rotulo v1.4
+    python loadtest.py --sessoes 16 --alunos 100000 --comparar loadtest_resultados/v1.4.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from unittest.mock import MagicMock
+from urllib import parse
+
+import numpy as np
+import pandas as pd
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+from saresp_core import build_dataset_entry
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+NIVEIS = ['Abaixo do Básico', 'Básico', 'Adequado', 'Avançado']
+
+# Perguntas enviadas em sequência por cada sessão: (tipo, texto); {codigo} vira um código de escola
+ROTEIRO = [
+    ('analise', "Analise os resultados da escola código {codigo}"),
+    ('direta', "Qual a média da turma 6A?"),
+    ('grafico', "Mostre gráfico da turma 6A por gênero"),
+    ('grafico', "distribuição de notas da escola {codigo}"),
+    ('direta', "quantos alunos no 7º ano?"),
+    ('analise', "Crie um plano de ação para melhorar matemática no 6º ano"),
+]
+
+class SessionScriptRunner(LocalScriptRunner):
+    """LocalScriptRunner com identificador de sessão escolhido (o original usa sempre "test session id")"""
+
+    def __init__(self, script_path, session_state, session_id):
+        super().__init__(script_path, session_state)
+        self._session_id = session_id
+
+class ConcurrentAppTest(AppTest):
+    """AppTest que pode rodar em várias threads ao mesmo tempo
+
+    O AppTest original troca o Runtime global a cada execução, o que quebra
+    sessões simultâneas; aqui o Runtime simulado é instalado uma única vez
+    (install_shared_runtime). Cada sessão roda com um session_id próprio, para
+    que o registro de memória do app veja sessões distintas. Depende da API
+    interna do Streamlit 1.31.
+    """
+
+    def __init__(self, script_path, *, default_timeout, session_id):
+        super().__init__(script_path, default_timeout=default_timeout)
+        self.session_id = session_id
+
+    def _run(self, widget_state=None, timeout=None):
+        script_runner = SessionScriptRunner(self._script_path, self.session_state, self.session_id)
+        self._tree = script_runner.run(widget_state, self.query_params, timeout or self.default_timeout)
+        self._tree._runner = self
+        query_string = script_runner.event_data[-1]["client_state"].query_string
+        self.query_params = parse.parse_qs(query_string)
+        return self
+
+def install_shared_runtime():
+    """Runtime simulado compartilhado por todas as sessões do teste"""
+    mock_runtime = MagicMock(spec=Runtime)
+    mock_runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    mock_runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = mock_runtime
+
+def make_synthetic_saresp(num_alunos, num_escolas, seed=0):
+    """Gera microdados EFAF sintéticos já com as colunas normalizadas"""
+    rng = np.random.default_rng(seed)
+    codigos = rng.choice(np.arange(5000, 5000 + num_escolas), num_alunos)
+    nota_mat = np.clip(rng.normal(4.5, 2.0, num_alunos), 0, 10).round(2)
+    return pd.DataFrame({
+        'codigo_escola': codigos,
+        'nome_escola': [f"ESCOLA {codigo}" for codigo in codigos],
+        'serie_ano': rng.choice(['6º Ano EF', '7º Ano EF', '9º Ano EF'], num_alunos),
+        'turma': rng.choice(['6A', 'A', 'B', 'C'], num_alunos),
+        'sexo': rng.choice(['F', 'M'], num_alunos),
+        'nota_lp': np.clip(rng.normal(5.0, 2.0, num_alunos), 0, 10).round(2),
+        'nota_mat': nota_mat,
+        'nota_ch': np.clip(rng.normal(5.0, 2.0, num_alunos), 0, 10).round(2),
+        'profic_mat': (150 + nota_mat * 20 + rng.normal(0, 10, num_alunos)).round(1),
+        'nivel_profic_mat': rng.choice(NIVEIS, num_alunos),
+    })
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGeminiModel:
+    """Substitui o Gemini: espera a latência configurada e devolve um texto fixo"""
+
+    def __init__(self, latency, jitter, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+
+    def generate_content(self, prompt):
+        time.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        return FakeResponse(f"## Resposta simulada\n\nPrompt recebido com {len(prompt)} caracteres.")
+
+def peak_rss_mb():
+    """Pico de memória residente do processo (MB)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa em KB, macOS em bytes
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def git_revision():
+    """Commit atual do repositório (para identificar a versão testada)"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(APP_PATH),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_session(session_idx, df, args, start_barrier, results):
+    """Uma sessão: abre o app com os dados carregados e envia as perguntas do roteiro"""
+    codigos = df['codigo_escola'].unique()
+    try:
+        at = ConcurrentAppTest(APP_PATH, default_timeout=args.timeout, session_id=f"loadtest-{session_idx}")
+        at.session_state['gemini_model'] = FakeGeminiModel(args.latencia, args.jitter, args.semente + session_idx)
+        at.session_state['dataframes'] = {'saresp_sintetico.csv': build_dataset_entry(df.copy(), 'saresp_sintetico.csv')}
+        at.run()
+        setup_error = str(at.exception[0].message) if at.exception else None
+    except Exception as e:
+        setup_error = str(e)
+
+    start_barrier.wait()
+    if setup_error:
+        print(f"  ❌ sessão {session_idx} não abriu o app: {setup_error}")
+        results.append({'sessao': session_idx, 'turno': None, 'tipo': 'abertura', 'latencia': None,
+                        'etapas': {}, 'erro': setup_error, 'fim': time.perf_counter()})
+        return
+
+    for turn in range(args.turnos):
+        tipo, template = ROTEIRO[(session_idx + turn) % len(ROTEIRO)]
+        prompt = template.format(codigo=codigos[(session_idx * 7 + turn) % len(codigos)])
+
+        at.session_state['perf_timings'] = {}
+        start = time.perf_counter()
+        error = None
+        try:
+            at.chat_input[0].set_value(prompt).run()
+            if at.exception:
+                error = str(at.exception[0].message)
+        except Exception as e:
+            error = str(e)
+        elapsed = time.perf_counter() - start
+
+        stages = {} if error else {name: sum(values) for name, values in at.session_state['perf_timings'].items()}
+        results.append({
+            'sessao': session_idx,
+            'turno': turn,
+            'tipo': tipo,
+            'latencia': elapsed,
+            'etapas': stages,
+            'erro': error,
+            'fim': time.perf_counter()
+        })
+
+def percentiles(values):
+    """p50/p95/p99 e máximo em segundos"""
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': round(p50, 4), 'p95': round(p95, 4), 'p99': round(p99, 4), 'max': round(max(values), 4)}
+
+def summarize(turns, wall_time):
+    """Consolida latências, vazão e distribuição do tempo por etapa"""
+    ok = [t for t in turns if not t['erro']]
+    latencies = [t['latencia'] for t in ok]
+
+    stage_totals = {}
+    for t in ok:
+        outros = t['latencia'] - sum(t['etapas'].values())
+        for name, seconds in list(t['etapas'].items()) + [('outros (render)', outros)]:
+            stage_totals.setdefault(name, []).append(seconds)
+    total_time = sum(latencies) or 1.0
+
+    return {
+        'turnos': len(turns),
+        'erros': len(turns) - len(ok),
+        'latencia': percentiles(latencies),
+        'latencia_por_tipo': {
+            tipo: percentiles([t['latencia'] for t in ok if t['tipo'] == tipo])
+            for tipo in sorted({t['tipo'] for t in ok})
+        },
+        'vazao_turnos_por_s': round(len(ok) / wall_time, 3) if wall_time else None,
+        'etapas': {
+            name: {
+                'total_s': round(sum(values), 4),
+                'participacao_pct': round(sum(values) / total_time * 100, 1),
+                'p50': round(float(np.percentile(values, 50)), 4)
+            }
+            for name, values in sorted(stage_totals.items(), key=lambda item: -sum(item[1]))
+        }
+    }
+
+def print_report(result):
+    """Mostra o resumo da execução no terminal"""
+    resumo = result['resumo']
+    print(f"\n📊 {resumo['turnos']} turno(s), {resumo['erros']} erro(s) em {result['duracao_s']:.1f}s")
+    if resumo['latencia']:
+        lat = resumo['latencia']
+        print(f"⏱️ Latência por turno: p50 {lat['p50']:.3f}s · p95 {lat['p95']:.3f}s · p99 {lat['p99']:.3f}s")
+        for tipo, lat in resumo['latencia_por_tipo'].items():
+            print(f"   - {tipo}: p50 {lat['p50']:.3f}s · p95 {lat['p95']:.3f}s")
+    print(f"🚀 Vazão: {resumo['vazao_turnos_por_s']} turnos/s")
+    print(f"💾 Pico de RSS: {result['pico_rss_mb']:.0f} MB (antes das sessões: {result['rss_inicial_mb']:.0f} MB)")
+    print("🔍 Tempo por etapa:")
+    for name, stage in resumo['etapas'].items():
+        print(f"   - {name}: {stage['participacao_pct']}% (p50 {stage['p50']:.4f}s)")
+
+def print_comparison(result, baseline_path):
+    """Compara latência, vazão e memória com uma execução anterior"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    def delta(new, old, unit):
+        return f"{new}{unit} ({(new - old) / old * 100:+.1f}%)" if old else f"{new}{unit}"
+
+    print(f"\n🆚 Comparação com {baseline.get('rotulo') or baseline_path} ({baseline.get('commit')}):")
+    old, new = baseline['resumo'], result['resumo']
+    if old.get('latencia') and new.get('latencia'):
+        for key in ['p50', 'p95', 'p99']:
+            print(f"   - latência {key}: {delta(new['latencia'][key], old['latencia'][key], 's')}")
+    print(f"   - vazão: {delta(new['vazao_turnos_por_s'], old['vazao_turnos_por_s'], ' turnos/s')}")
+    print(f"   - pico de RSS: {delta(round(result['pico_rss_mb']), round(baseline['pico_rss_mb']), ' MB')}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Teste de carga do app com sessões simultâneas e Gemini simulado")
+    parser.add_argument('--sessoes', type=int, default=4, help="Sessões simultâneas (padrão: 4)")
+    parser.add_argument('--turnos', type=int, default=len(ROTEIRO), help=f"Perguntas por sessão (padrão: {len(ROTEIRO)})")
+    parser.add_argument('--latencia', type=float, default=1.0, help="Latência média do Gemini simulado em segundos (padrão: 1.0)")
+    parser.add_argument('--jitter', type=float, default=0.2, help="Variação da latência simulada em segundos (padrão: 0.2)")
+    parser.add_argument('--alunos', type=int, default=20000, help="Alunos no arquivo sintético de cada sessão (padrão: 20000)")
+    parser.add_argument('--escolas', type=int, default=50, help="Escolas no arquivo sintético (padrão: 50)")
+    parser.add_argument('--semente', type=int, default=0, help="Semente dos dados e latências (padrão: 0)")
+    parser.add_argument('--timeout', type=float, default=120, help="Tempo máximo de um turno em segundos (padrão: 120)")
+    parser.add_argument('--rotulo', help="Nome da execução (ex.: versão); usado no nome do arquivo")
+    parser.add_argument('--saida', default='loadtest_resultados', help="Diretório dos resultados (padrão: loadtest_resultados)")
+    parser.add_argument('--comparar', help="JSON de uma execução anterior para comparação")
+    args = parser.parse_args(argv)
+
+    print(f"🧪 {args.sessoes} sessão(ões) × {args.turnos} turno(s), {args.alunos} alunos, Gemini simulado {args.latencia}s")
+    df = make_synthetic_saresp(args.alunos, args.escolas, args.semente)
+    install_shared_runtime()
+    rss_start = peak_rss_mb()
+
+    turns = []
+    start_barrier = threading.Barrier(args.sessoes + 1)
+    threads = [
+        threading.Thread(target=run_session, args=(idx, df, args, start_barrier, turns), daemon=True)
+        for idx in range(args.sessoes)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Todas as sessões começam a conversar juntas, depois de abrir o app e carregar os dados
+    start_barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall_time = max((t['fim'] for t in turns), default=start) - start
+
+    result = {
+        'rotulo': args.rotulo,
+        'commit': git_revision(),
+        'executado_em': datetime.now().isoformat(timespec='seconds'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('saida', 'comparar')},
+        'ambiente': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'cpus': os.cpu_count(),
+            'plataforma': platform.platform()
+        },
+        'duracao_s': round(wall_time, 3),
+        'rss_inicial_mb': round(rss_start, 1),
+        'pico_rss_mb': round(peak_rss_mb(), 1),
+        'resumo': summarize(turns, wall_time),
+        'turnos': [{k: v for k, v in t.items() if k != 'fim'} for t in turns]
+    }
+
+    print_report(result)
+    if args.comparar:
+        print_comparison(result, args.comparar)
+
+    os.makedirs(args.saida, exist_ok=True)
+    name = args.rotulo or datetime.now().strftime('%Y%m%d_%H%M%S')
+    path = os.path.join(args.saida, f"{name}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Resultado salvo em {path}")
+    return 1 if result['resumo']['erros'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""
+Pré-processamento offline dos microdados SARESP.
+
+Lê arquivos estaduais completos uma única vez, normaliza as colunas, calcula a
+análise de cada arquivo e grava um shard Parquet por escola (codigo_escola),
+além de um manifest.json. O app abre o manifesto e carrega apenas os shards
+das escolas citadas no chat. Com --sqlite, os arquivos também são gravados no
+banco compartilhado usado pelo app quando SARESP_SQLITE_PATH está definido.
+
+Uso:
+    python precompute.py microdados_2023_efaf.csv microdados_2023_em.xlsx --saida dados_preprocessados
+    python precompute.py microdados_2023_efaf.csv --sqlite saresp.db
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+from datetime import datetime
+
+import pandas as pd
+
+from saresp_core import (
+    analyze_dataframe,
+    build_aggregate_cube,
+    build_school_ranking,
+    read_data_file,
+    save_to_store,
+    school_key,
+    to_jsonable,
+)
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+def shard_dirname(filename):
+    """Nome de diretório seguro para os shards de um arquivo"""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', stem)
+
+def prepare_for_parquet(df):
+    """Converte colunas de texto com tipos misturados (ex.: turma 6 e '6A') para string"""
+    for col in df.columns:
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True).startswith('mixed'):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+def precompute_file(path, output_dir, sqlite_path=None):
+    """Gera os shards por escola de um arquivo e retorna sua entrada no manifesto"""
+    filename = os.path.basename(path)
+    with open(path, 'rb') as file:
+        df, _ = read_data_file(file)
+    
+    if df is None:
+        raise ValueError(f"formato não suportado: {filename}")
+    if 'codigo_escola' not in df.columns:
+        raise ValueError(f"{filename} não possui coluna de código da escola")
+    
+    df = prepare_for_parquet(df)
+    analysis = analyze_dataframe(df, filename)
+    ranking = build_school_ranking(build_aggregate_cube(df))
+    
+    if sqlite_path:
+        save_to_store(sqlite_path, filename, df, analysis, ranking)
+    
+    relative_dir = f"shards/{shard_dirname(filename)}"
+    os.makedirs(os.path.join(output_dir, relative_dir), exist_ok=True)
+    
+    escolas = {}
+    for codigo, school_df in df.groupby('codigo_escola', sort=False):
+        key = school_key(codigo)
+        shard = f"{relative_dir}/{key}.parquet"
+        school_df.to_parquet(os.path.join(output_dir, shard), index=False)
+        
+        escolas[key] = {
+            'shard': shard,
+            'total_alunos': len(school_df)
+        }
+        if 'nome_escola' in school_df.columns:
+            escolas[key]['nome_escola'] = to_jsonable(school_df['nome_escola'].iloc[0])
+    
+    sem_codigo = int(df['codigo_escola'].isna().sum())
+    if sem_codigo:
+        print(f"  ⚠️ {sem_codigo} aluno(s) sem código de escola ignorado(s)")
+    
+    entry = {
+        'analysis': to_jsonable(analysis),
+        'escolas': escolas
+    }
+    
+    # Ranking das escolas no arquivo estadual (os shards só conhecem a própria escola);
+    # arquivo sem alunos não tem cubo nem ranking e fica sem a chave no manifesto
+    if ranking is not None:
+        os.makedirs(os.path.join(output_dir, 'rankings'), exist_ok=True)
+        ranking_file = f"rankings/{shard_dirname(filename)}.parquet"
+        ranking['table'].to_parquet(os.path.join(output_dir, ranking_file))
+        entry['ranking'] = {
+            'tabela': ranking_file,
+            'metrics': ranking['metrics'],
+            'levels': ranking['levels'],
+            'rede': to_jsonable(ranking['rede'])
+        }
+    
+    return entry
+
+def load_manifest(output_dir):
+    """Lê o manifesto existente (para acrescentar arquivos) ou cria um novo"""
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    return {'versao': MANIFEST_VERSION, 'arquivos': {}}
+
+def write_manifest(output_dir, manifest):
+    """Grava o manifesto de forma atômica"""
+    manifest['gerado_em'] = datetime.now().isoformat(timespec='seconds')
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gera shards por escola a partir dos microdados SARESP")
+    parser.add_argument('arquivos', nargs='+', help="Arquivos SARESP (CSV, XLSX, XLS)")
+    parser.add_argument('--saida', default='dados_preprocessados', help="Diretório de saída (padrão: dados_preprocessados)")
+    parser.add_argument('--sqlite', help="Também grava os arquivos neste banco SQLite compartilhado")
+    args = parser.parse_args(argv)
+    
+    os.makedirs(args.saida, exist_ok=True)
+    manifest = load_manifest(args.saida)
+    
+    falhas = 0
+    for path in args.arquivos:
+        print(f"📄 Processando {path}...")
+        try:
+            entry = precompute_file(path, args.saida, args.sqlite)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print(f"  ❌ {e}")
+            falhas += 1
+            continue
+        
+        manifest['arquivos'][os.path.basename(path)] = entry
+        # Grava a cada arquivo para não perder o trabalho feito se um arquivo posterior falhar
+        write_manifest(args.saida, manifest)
+        print(f"  ✅ {entry['analysis']['total_alunos']} alunos, {len(entry['escolas'])} escolas")
+    
+    if manifest['arquivos']:
+        print(f"\nManifesto: {os.path.join(args.saida, MANIFEST_NAME)}")
+    return 1 if falhas else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
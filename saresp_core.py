@@ -0,0 +1,1795 @@
+"""
+Núcleo de dados do Agente SARESP, sem interface.
+
+Leitura e normalização dos arquivos, registro de layouts, análise, filtros,
+cubo pré-agregado, sketches, ranking, banco SQLite, modo longitudinal e
+montagem do contexto/prompt do Gemini. Não chama o Streamlit na importação:
+é usado pelo app.py e pelos scripts de linha de comando (precompute.py,
+batch_reports.py, loadtest.py).
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import google.generativeai as genai
+import numpy as np
+import pandas as pd
+import PyPDF2
+import streamlit as st
+
+logger = logging.getLogger("saresp")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.setLevel(os.getenv("SARESP_LOG_LEVEL", "INFO"))
+
+GEMINI_MODEL_NAME = 'gemini-2.5-pro'
+
+def get_api_key():
+    """Lê GOOGLE_API_KEY das secrets do Streamlit ou da variável de ambiente"""
+    # Sem secrets.toml não acessa st.secrets (que mostraria st.error fora do `streamlit run`)
+    if st.secrets.load_if_toml_exists():
+        return st.secrets.get("GOOGLE_API_KEY", os.getenv("GOOGLE_API_KEY"))
+    return os.getenv("GOOGLE_API_KEY")
+
+def create_gemini_model(api_key):
+    """Configura a API e cria o modelo Gemini"""
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+def standard_column_name(col):
+    """Retorna o nome padrão de uma coluna do arquivo (ou None se não houver mapeamento)"""
+    col_lower = col.lower().strip()
+    
+    # Mapeamento para colunas padrão
+    if 'código' in col_lower and 'escola' in col_lower or 'codesc' in col_lower:
+        return 'codigo_escola'
+    elif 'nome' in col_lower and 'escola' in col_lower or 'nomesc' in col_lower:
+        return 'nome_escola'
+    elif col_lower in ['serie_ano', 'série_ano', 'serie', 'ano']:
+        return 'serie_ano'
+    elif col_lower == 'turma':
+        return 'turma'
+    elif col_lower == 'sexo':
+        return 'sexo'
+    return None
+
+def build_column_mapping(columns):
+    """Monta o mapeamento coluna do arquivo -> nome padrão"""
+    column_mapping = {}
+    for col in columns:
+        standard = standard_column_name(str(col))
+        if standard:
+            column_mapping[col] = standard
+    return column_mapping
+
+def normalize_column_names(df):
+    """Normaliza nomes de colunas para padrão consistente"""
+    column_mapping = build_column_mapping(df.columns)
+    
+    if column_mapping:
+        df = df.rename(columns=column_mapping)
+    
+    return df
+
+# Registro de layouts conhecidos (cabeçalho -> plano de leitura tipado)
+SCHEMA_REGISTRY_PATH = os.getenv("SARESP_SCHEMA_REGISTRY", "saresp_schemas.json")
+
+@functools.lru_cache(maxsize=None)
+def get_schema_registry():
+    """Registro de layouts compartilhado entre as sessões, persistido em JSON"""
+    layouts = {}
+    if os.path.exists(SCHEMA_REGISTRY_PATH):
+        try:
+            with open(SCHEMA_REGISTRY_PATH, encoding='utf-8') as f:
+                layouts = json.load(f).get('layouts', {})
+        except (OSError, ValueError) as e:
+            logger.warning("registro de layouts ignorado (%s): %s", SCHEMA_REGISTRY_PATH, e)
+    return {'lock': threading.Lock(), 'layouts': layouts}
+
+def header_fingerprint(file_format, columns):
+    """Assinatura do layout: formato + nomes das colunas do cabeçalho, na ordem"""
+    header = "\x1f".join(str(col) for col in columns)
+    return f"{file_format}:{hashlib.sha1(header.encode('utf-8')).hexdigest()}"
+
+def read_header(file, file_format):
+    """Lê só o cabeçalho do arquivo e volta ao início"""
+    if file_format == 'excel':
+        columns = pd.read_excel(file, nrows=0).columns
+    else:
+        columns = pd.read_csv(file, nrows=0).columns
+    file.seek(0)
+    return list(columns)
+
+def is_pinned_dtype(dtype):
+    """Só tipos numéricos/booleanos entram no plano; texto (object) é sempre inferido de novo"""
+    # Um único 'AUS' numa coluna de nota do primeiro arquivo não pode transformar a coluna em texto nos demais
+    return pd.api.types.pandas_dtype(dtype).kind in 'biuf'
+
+def build_read_plan(df, previous=None):
+    """Plano de leitura de um layout a partir do DataFrame lido com inferência"""
+    # Colunas sem nome e totalmente vazias (índices exportados sem valor) não são lidas nas próximas vezes
+    usecols = [col for col in df.columns
+               if not (str(col).startswith('Unnamed:') and df[col].isna().all())
+               or previous and col in previous['usecols']]
+    dtypes = {col: str(df[col].dtype) for col in usecols if is_pinned_dtype(df[col].dtype)}
+    if previous:
+        # Plano anterior falhou: fixa só os tipos em que os arquivos concordam, o resto volta a ser inferido
+        dtypes = {col: dtype for col, dtype in dtypes.items() if previous['dtypes'].get(col) == dtype}
+    column_mapping = build_column_mapping(usecols)
+    tipo, disciplinas = detect_saresp_type([column_mapping.get(col, col) for col in usecols])
+    return {
+        'column_mapping': column_mapping,
+        'dtypes': dtypes,
+        'usecols': usecols,
+        'tipo': tipo,
+        'disciplinas': disciplinas,
+        'registrado_em': datetime.now().isoformat(timespec='seconds')
+    }
+
+def register_read_plan(fingerprint, plan):
+    """Guarda o plano no registro e regrava o JSON"""
+    registry = get_schema_registry()
+    with registry['lock']:
+        registry['layouts'][fingerprint] = plan
+        try:
+            tmp_path = SCHEMA_REGISTRY_PATH + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'layouts': registry['layouts']}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, SCHEMA_REGISTRY_PATH)
+        except OSError as e:
+            # Sem disco gravável o registro continua valendo para o processo
+            logger.warning("não foi possível gravar %s: %s", SCHEMA_REGISTRY_PATH, e)
+
+def read_with_plan(file, file_format, plan):
+    """Lê o arquivo com colunas e tipos numéricos explícitos (colunas de texto continuam inferidas)"""
+    # Planos gravados antes podem ter 'object' fixado: esses tipos são ignorados
+    dtypes = {col: dtype for col, dtype in plan['dtypes'].items() if is_pinned_dtype(dtype)}
+    if file_format == 'excel':
+        return pd.read_excel(file, usecols=plan['usecols'], dtype=dtypes)
+    return pd.read_csv(file, usecols=plan['usecols'], dtype=dtypes)
+
+def read_data_file(file):
+    """Lê arquivo (upload ou arquivo aberto em disco) e retorna DataFrame com colunas normalizadas"""
+    ext = file.name.split('.')[-1].lower()
+    
+    if ext in ['xlsx', 'xls']:
+        file_format = 'excel'
+    elif ext == 'csv':
+        file_format = 'csv'
+    elif ext == 'pdf':
+        pdf = PyPDF2.PdfReader(file)
+        text = "\n".join([page.extract_text() for page in pdf.pages])
+        return None, text
+    else:
+        return None, None
+    
+    fingerprint = header_fingerprint(file_format, read_header(file, file_format))
+    plan = get_schema_registry()['layouts'].get(fingerprint)
+    previous = None
+    df = None
+    
+    if plan:
+        try:
+            df = read_with_plan(file, file_format, plan)
+            logger.info("layout conhecido %s: %s", fingerprint, file.name)
+        except (ValueError, TypeError) as e:
+            # Ex.: coluna inteira que passou a ter valores vazios; relê com inferência e atualiza o plano
+            logger.info("plano de leitura de %s não serve para %s (%s)", fingerprint, file.name, e)
+            file.seek(0)
+            previous = plan
+    
+    if df is None:
+        if file_format == 'excel':
+            df = pd.read_excel(file)
+        else:
+            df = pd.read_csv(file)
+        plan = build_read_plan(df, previous)
+        if len(plan['usecols']) < len(df.columns):
+            df = df[plan['usecols']]
+        register_read_plan(fingerprint, plan)
+        logger.info("plano de leitura registrado %s (%s): %s", fingerprint, plan['tipo'], file.name)
+    
+    # Normaliza nomes de colunas pelo mapeamento do layout
+    df = df.rename(columns=plan['column_mapping'])
+    df.attrs['saresp_tipo'] = [plan['tipo'], plan['disciplinas']]
+    
+    return df, None
+
+def detect_saresp_type(columns):
+    """Identifica o tipo de arquivo SARESP (EFAI, EFAF, EM) pelas colunas"""
+    if 'profic_lp' in columns:
+        return 'EFAI - Anos Iniciais', ['Língua Portuguesa', 'Matemática']
+    elif 'nota_ch' in columns:
+        return 'EFAF - Anos Finais', ['LP', 'Inglês', 'Ciências', 'Matemática', 'História', 'Geografia']
+    elif 'nota_fil' in columns:
+        return 'EM - Ensino Médio', ['LP', 'Inglês', 'Biologia', 'Física', 'Química', 'Matemática', 'Geografia', 'História', 'Filosofia']
+    return 'Genérico', []
+
+# Colunas que trazem o ano da edição da prova (quando o arquivo não tem o ano no nome)
+EDITION_YEAR_COLUMNS = ['ano_edicao', 'edicao', 'ano_aplicacao', 'nu_ano']
+
+def detect_edition_year(filename, df=None):
+    """Identifica o ano da edição do SARESP pela coluna de edição ou pelo nome do arquivo (ou None)"""
+    if df is not None:
+        for col in EDITION_YEAR_COLUMNS:
+            if col in df.columns:
+                years = pd.to_numeric(df[col], errors='coerce').dropna().unique()
+                if len(years) == 1 and 2000 <= years[0] <= 2100:
+                    return int(years[0])
+    
+    # Nome como "microdados_2023_efaf.csv"; nomes com dois anos diferentes ficam sem edição
+    years = set(re.findall(r'(?<!\d)(20\d{2})(?!\d)', filename))
+    return int(years.pop()) if len(years) == 1 else None
+
+def get_metric_columns(df):
+    """Retorna colunas numéricas de métricas (notas, proficiências, porcentagens, acertos)"""
+    return [col for col in df.columns if 
+            (col.startswith('nota_') or 
+             col.startswith('profic_') or 
+             col.startswith('porc_') or
+             col.startswith('acertos_')) and 
+            pd.api.types.is_numeric_dtype(df[col])]
+
+def get_level_columns(df):
+    """Retorna colunas de níveis de proficiência/classificação"""
+    return [col for col in df.columns if 
+            col.startswith('nivel_profic_') or 
+            col.startswith('nivSaeb_') or
+            col.startswith('classific_')]
+
+def analyze_dataframe(df, filename, filters_info=None, sketches=None):
+    """Analisa DataFrame e retorna resumo estruturado"""
+    
+    if df.empty:
+        return {
+            'filename': filename,
+            'total_alunos': 0,
+            'colunas': [],
+            'tipo': 'Nenhum dado encontrado',
+            'filters_applied': filters_info
+        }
+
+    analysis = {
+        'filename': filename,
+        'total_alunos': len(df),
+        'total_colunas': len(df.columns),
+        'colunas': list(df.columns),
+        'filters_applied': filters_info
+    }
+    
+    # Identifica tipo de dados
+    analysis['tipo'], analysis['disciplinas'] = df.attrs.get('saresp_tipo') or detect_saresp_type(df.columns)
+    analysis['ano_edicao'] = detect_edition_year(filename, df)
+    
+    # Estatísticas de notas principais
+    if 'nota_lp' in df.columns and pd.api.types.is_numeric_dtype(df['nota_lp']):
+        analysis['media_lp'] = round(df['nota_lp'].mean(), 2)
+        analysis['min_lp'] = round(df['nota_lp'].min(), 2)
+        analysis['max_lp'] = round(df['nota_lp'].max(), 2)
+    
+    if 'nota_mat' in df.columns and pd.api.types.is_numeric_dtype(df['nota_mat']):
+        analysis['media_mat'] = round(df['nota_mat'].mean(), 2)
+        analysis['min_mat'] = round(df['nota_mat'].min(), 2)
+        analysis['max_mat'] = round(df['nota_mat'].max(), 2)
+    
+    # Estatísticas de todas as métricas numéricas
+    numeric_cols = get_metric_columns(df)
+    
+    analysis['numeric_stats'] = {}
+    for col in numeric_cols:
+        if sketches and col in sketches:
+            # Mediana e quartis pelo sketch de distribuição, sem ordenar a coluna inteira
+            quantis = sketch_stats(sketches[col])
+            mediana = quantis['mediana']
+        else:
+            quantis = None
+            mediana = df[col].median()
+        analysis['numeric_stats'][col] = {
+            'media': round(df[col].mean(), 2),
+            'min': round(df[col].min(), 2),
+            'max': round(df[col].max(), 2),
+            'mediana': round(mediana, 2)
+        }
+        if quantis:
+            analysis['numeric_stats'][col]['p25'] = round(quantis['p25'], 2)
+            analysis['numeric_stats'][col]['p75'] = round(quantis['p75'], 2)
+    
+    # Distribuições de níveis
+    level_cols = get_level_columns(df)
+    
+    analysis['level_distributions'] = {}
+    for col in level_cols:
+        if col in df.columns:
+            distribution = df[col].value_counts(normalize=True) * 100
+            analysis['level_distributions'][col] = distribution.round(2).to_dict()
+    
+    # Informações de agrupamento
+    if 'serie_ano' in df.columns:
+        analysis['series'] = df['serie_ano'].value_counts().to_dict()
+    
+    if 'sexo' in df.columns:
+        analysis['genero'] = df['sexo'].value_counts().to_dict()
+    
+    if 'turma' in df.columns:
+        analysis['turmas'] = df['turma'].value_counts().to_dict()
+    
+    if 'nome_escola' in df.columns:
+        analysis['num_escolas'] = df['nome_escola'].nunique()
+        analysis['nomes_escolas'] = df['nome_escola'].unique().tolist()[:10]  # Limita a 10
+    
+    if 'codigo_escola' in df.columns:
+        analysis['num_cod_escolas'] = df['codigo_escola'].nunique()
+        analysis['cods_escolas'] = df['codigo_escola'].unique().tolist()[:10]  # Limita a 10
+    
+    return analysis
+
+def extract_filters_from_prompt(prompt):
+    """Extrai filtros do prompt do usuário de forma inteligente"""
+    filters = {
+        'codigo_escola': None,
+        'nome_escola': None,
+        'turma': None,
+        'serie_ano': None,
+        'sexo': None
+    }
+    
+    prompt_lower = prompt.lower()
+    
+    # 1. CÓDIGO DA ESCOLA
+    # Padrões: "código 5174", "escola 5174", "código da escola 5174", "cod 5174"
+    patterns_codigo = [
+        r'(?:c[oó]digo\s+(?:da\s+)?escola|escola|cod\.?)\s+(\d{4,6})',
+        r'(?:escola\s+de\s+c[oó]digo|com\s+c[oó]digo)\s+(\d{4,6})'
+    ]
+    
+    for pattern in patterns_codigo:
+        match = re.search(pattern, prompt_lower)
+        if match:
+            filters['codigo_escola'] = int(match.group(1))
+            break
+    
+    # 2. NOME DA ESCOLA (mais complexo)
+    # Padrões: "da escola [NOME]", "escola [NOME]"
+    patterns_nome = [
+        r'(?:da\s+escola|escola)\s+([A-ZÁÉÍÓÚÂÊÎÔÛÃÕ][A-ZÁÉÍÓÚÂÊÎÔÛÃÕa-záéíóúâêîôûãõ\s\.]{5,})',
+        r'(?:na\s+escola|para\s+a\s+escola)\s+([A-ZÁÉÍÓÚÂÊÎÔÛÃÕ][A-ZÁÉÍÓÚÂÊÎÔÛÃÕa-záéíóúâêîôûãõ\s\.]{5,})'
+    ]
+    
+    for pattern in patterns_nome:
+        match = re.search(pattern, prompt, re.IGNORECASE)
+        if match and not filters['codigo_escola']:  # Só usa nome se não achou código
+            filters['nome_escola'] = match.group(1).strip()
+            break
+    
+    # 3. TURMA
+    # Padrões: "turma A", "turma 6A", "da turma B"
+    match = re.search(r'(?:turma|da\s+turma)\s+([A-Z0-9]{1,3})', prompt, re.IGNORECASE)
+    if match:
+        filters['turma'] = match.group(1).upper()
+    
+    # 4. SÉRIE/ANO
+    # Padrões: "6º ano", "série 6", "do 7º", "ano 5"
+    patterns_serie = [
+        r'(?<!\d)(\d{1,2})[ºª°]?\s*(?:ano|série)',
+        r'(?:ano|série)\s+(\d{1,2})(?!\d)',  # "ano 2022" é a edição, não a série
+        r'do\s+(\d{1,2})[ºª°]'
+    ]
+    
+    for pattern in patterns_serie:
+        match = re.search(pattern, prompt_lower)
+        if match:
+            filters['serie_ano'] = match.group(1)
+            break
+    
+    # 5. SEXO/GÊNERO
+    if any(word in prompt_lower for word in ['feminino', 'femininas', 'meninas', 'alunas']):
+        filters['sexo'] = 'F'
+    elif any(word in prompt_lower for word in ['masculino', 'masculinos', 'meninos']):
+        filters['sexo'] = 'M'
+    
+    # Remove None values
+    filters = {k: v for k, v in filters.items() if v is not None}
+    
+    return filters
+
+def describe_filter(key, value):
+    """Retorna o rótulo exibido para um filtro aplicado"""
+    if key == 'codigo_escola':
+        return f"Código da escola: {value}"
+    elif key == 'nome_escola':
+        return f"Escola: {value}"
+    elif key == 'turma':
+        return f"Turma: {value}"
+    elif key == 'serie_ano':
+        return f"Série/Ano: {value}"
+    elif key == 'sexo':
+        genero_text = "Feminino" if value == 'F' else "Masculino"
+        return f"Gênero: {genero_text}"
+    return f"{key}: {value}"
+
+def filter_mask(df, filters):
+    """Máscara booleana das linhas que passam nos filtros e rótulos dos filtros aplicados"""
+    mask = np.ones(len(df), dtype=bool)
+    filters_applied = []
+    
+    for key, value in filters.items():
+        if key not in ['codigo_escola', 'nome_escola', 'turma', 'serie_ano', 'sexo'] or key not in df.columns:
+            continue
+        
+        # Cada filtro é avaliado só nas linhas que passaram pelos anteriores
+        selected = df[key][mask]
+        if key == 'nome_escola':
+            # Busca parcial case-insensitive
+            match = selected.str.contains(value, case=False, na=False)
+        elif key == 'serie_ano':
+            # Tenta converter série para diferentes formatos
+            match = selected.astype(str).str.contains(str(value), na=False)
+        else:
+            match = selected == value
+        match = match.to_numpy(dtype=bool)
+        
+        # Filtro sem nenhum aluno correspondente é ignorado
+        if not match.any():
+            continue
+        if key == 'nome_escola':
+            value = selected[match].iloc[0]
+        mask[mask] = match
+        filters_applied.append(describe_filter(key, value))
+    
+    return mask, filters_applied
+
+def apply_filters_to_dataframe(df, filters):
+    """Aplica filtros ao DataFrame"""
+    mask, filters_applied = filter_mask(df, filters)
+    
+    if filters_applied:
+        return df[mask], filters_applied
+    else:
+        return None, None
+
+# Dimensões do cubo pré-agregado (mesmas chaves reconhecidas por extract_filters_from_prompt)
+CUBE_DIMENSIONS = ['codigo_escola', 'nome_escola', 'serie_ano', 'turma', 'sexo']
+
+def build_aggregate_cube(df):
+    """Pré-agrega métricas por escola × série × turma × sexo para consultas sem varrer os alunos"""
+    dims = [col for col in CUBE_DIMENSIONS if col in df.columns]
+    if not dims or df.empty:
+        return None
+    
+    metrics = get_metric_columns(df)
+    levels = get_level_columns(df)
+    
+    # Cada combinação observada das dimensões vira uma célula
+    cell_ids = df.groupby(dims, dropna=False, observed=True, sort=False).ngroup().to_numpy()
+    
+    base = pd.DataFrame({'__cell': cell_ids, '__pos': np.arange(len(df))})
+    agg_spec = {'__pos': ['size', 'min']}
+    for col in dims:
+        base[col] = df[col].to_numpy()
+        agg_spec[col] = ['first']
+    for col in metrics:
+        values = df[col].astype('float64').to_numpy()
+        base[col] = values
+        base[f'{col}__sq'] = values ** 2
+        agg_spec[col] = ['count', 'sum', 'min', 'max']
+        agg_spec[f'{col}__sq'] = ['sum']
+    
+    cells = base.groupby('__cell', sort=True).agg(agg_spec)
+    column_names = {
+        ('__pos', 'size'): '__rows',
+        ('__pos', 'min'): '__first_pos'
+    }
+    cells.columns = [
+        column_names.get((col, stat),
+                         col if stat == 'first' else
+                         f"{col[:-4]}__sumsq" if col.endswith('__sq') else
+                         f"{col}__{stat}")
+        for col, stat in cells.columns
+    ]
+    
+    # Três primeiras linhas de cada célula, para montar amostras sem filtrar os alunos
+    first_rows = base.groupby('__cell', sort=False).head(3)
+    sample_positions = pd.Series(first_rows['__pos'].to_numpy(), index=first_rows['__cell'].to_numpy())
+    
+    # Contagem de alunos por nível em cada célula
+    level_tallies = {}
+    for col in levels:
+        tallies = pd.DataFrame({'__cell': cell_ids, 'nivel': df[col].to_numpy()})
+        tallies = tallies.groupby(['__cell', 'nivel']).size().unstack('nivel', fill_value=0)
+        level_tallies[col] = tallies.reindex(cells.index, fill_value=0)
+    
+    return {
+        'dims': dims,
+        'metrics': metrics,
+        'levels': levels,
+        'columns': list(df.columns),
+        'tipo': df.attrs.get('saresp_tipo') or detect_saresp_type(df.columns),
+        'cells': cells,
+        'sample_positions': sample_positions,
+        'level_tallies': level_tallies
+    }
+
+def full_cube_view(cube):
+    """Retorna uma visão do cubo sem filtros (todas as células)"""
+    if cube is None:
+        return None
+    return {
+        'cube': cube,
+        'mask': pd.Series(True, index=cube['cells'].index),
+        'filters': {},
+        'filters_applied': [],
+        'applied_keys': []
+    }
+
+def query_cube(cube, filters):
+    """Aplica filtros sobre as células do cubo (mesma semântica de apply_filters_to_dataframe)"""
+    if cube is None or not filters:
+        return None
+    
+    cells = cube['cells']
+    mask = pd.Series(True, index=cells.index)
+    filters_applied = []
+    applied_keys = []
+    
+    for key, value in filters.items():
+        if key not in cube['dims']:
+            continue
+        
+        column = cells[key]
+        if key == 'nome_escola':
+            condition = column.str.contains(value, case=False, na=False)
+        elif key == 'serie_ano':
+            condition = column.astype(str).str.contains(str(value), na=False)
+        else:
+            condition = column == value
+        
+        candidate = mask & condition
+        if candidate.any():
+            mask = candidate
+            if key == 'nome_escola':
+                # Nome da primeira linha encontrada, como no filtro sobre o DataFrame
+                first_cell = cells.loc[mask, '__first_pos'].idxmin()
+                value = cells.at[first_cell, 'nome_escola']
+            filters_applied.append(describe_filter(key, value))
+            applied_keys.append(key)
+    
+    if not filters_applied:
+        return None
+    
+    return {
+        'cube': cube,
+        'mask': mask,
+        'filters': filters,
+        'filters_applied': filters_applied,
+        'applied_keys': applied_keys
+    }
+
+def cube_metric_stats(view, col):
+    """Consolida contagem, média, desvio, mínimo e máximo de uma métrica nas células da visão"""
+    cells = view['cube']['cells'].loc[view['mask']]
+    count = cells[f'{col}__count'].sum()
+    total = cells[f'{col}__sum'].sum()
+    total_sq = cells[f'{col}__sumsq'].sum()
+    
+    if count == 0:
+        return {'count': 0, 'media': np.nan, 'desvio': np.nan, 'min': np.nan, 'max': np.nan}
+    
+    mean = total / count
+    variance = max(total_sq / count - mean ** 2, 0.0)
+    return {
+        'count': int(count),
+        'media': mean,
+        'desvio': np.sqrt(variance),
+        'min': cells[f'{col}__min'].min(),
+        'max': cells[f'{col}__max'].max()
+    }
+
+def cube_group_counts(view, by):
+    """Conta alunos por valor de uma dimensão (equivalente a value_counts)"""
+    cells = view['cube']['cells'].loc[view['mask']]
+    return cells.groupby(by)['__rows'].sum().sort_values(ascending=False, kind='stable')
+
+def cube_group_means(view, by, columns):
+    """Calcula médias por valor de uma dimensão (equivalente a groupby(by)[columns].mean())"""
+    cells = view['cube']['cells'].loc[view['mask']]
+    grouped = cells.groupby(by)
+    result = pd.DataFrame(index=grouped.size().index)
+    for col in columns:
+        counts = grouped[f'{col}__count'].sum()
+        result[col] = grouped[f'{col}__sum'].sum() / counts.replace(0, np.nan)
+    return result.reset_index()
+
+def cube_level_counts(view, col):
+    """Conta alunos por nível de uma coluna de classificação"""
+    tallies = view['cube']['level_tallies'][col].loc[view['mask']].sum()
+    return tallies[tallies > 0].sort_values(ascending=False, kind='stable')
+
+def cube_sample_positions(view, n=3):
+    """Retorna posições das primeiras linhas de alunos da visão"""
+    positions = view['cube']['sample_positions']
+    selected = view['mask'].index[view['mask'].to_numpy()]
+    return positions[positions.index.isin(selected)].nsmallest(n).sort_values().tolist()
+
+def summarize_cube_view(view, filename, sketches=None):
+    """Monta a análise de analyze_dataframe a partir do cubo, sem varrer os alunos"""
+    cube = view['cube']
+    cells = cube['cells'].loc[view['mask']]
+    filters_info = view['filters_applied'] or None
+    
+    total = int(cells['__rows'].sum())
+    if total == 0:
+        return {
+            'filename': filename,
+            'total_alunos': 0,
+            'colunas': [],
+            'tipo': 'Nenhum dado encontrado',
+            'filters_applied': filters_info
+        }
+    
+    analysis = {
+        'filename': filename,
+        'total_alunos': total,
+        'total_colunas': len(cube['columns']),
+        'colunas': list(cube['columns']),
+        'filters_applied': filters_info
+    }
+    analysis['tipo'], analysis['disciplinas'] = cube['tipo']
+    
+    analysis['numeric_stats'] = {}
+    for col in cube['metrics']:
+        stats = cube_metric_stats(view, col)
+        analysis['numeric_stats'][col] = {
+            'media': round(stats['media'], 2),
+            'min': round(stats['min'], 2),
+            'max': round(stats['max'], 2)
+        }
+        # Mediana e quartis só quando há sketch que cobre exatamente a visão
+        if sketches and col in sketches:
+            quantis = sketch_stats(sketches[col])
+            for key in ['p25', 'mediana', 'p75']:
+                analysis['numeric_stats'][col][key] = round(quantis[key], 2)
+    
+    for col, suffix in [('nota_lp', 'lp'), ('nota_mat', 'mat')]:
+        if col in analysis['numeric_stats']:
+            analysis[f'media_{suffix}'] = analysis['numeric_stats'][col]['media']
+            analysis[f'min_{suffix}'] = analysis['numeric_stats'][col]['min']
+            analysis[f'max_{suffix}'] = analysis['numeric_stats'][col]['max']
+    
+    analysis['level_distributions'] = {}
+    for col in cube['levels']:
+        counts = cube_level_counts(view, col)
+        if counts.sum() > 0:
+            analysis['level_distributions'][col] = (counts / counts.sum() * 100).round(2).to_dict()
+    
+    if 'serie_ano' in cube['dims']:
+        analysis['series'] = cube_group_counts(view, 'serie_ano').to_dict()
+    
+    if 'sexo' in cube['dims']:
+        analysis['genero'] = cube_group_counts(view, 'sexo').to_dict()
+    
+    if 'turma' in cube['dims']:
+        analysis['turmas'] = cube_group_counts(view, 'turma').to_dict()
+    
+    # Ordem de aparição nos dados, como em unique()
+    ordered = cells.sort_values('__first_pos')
+    if 'nome_escola' in cube['dims']:
+        nomes = ordered['nome_escola'].drop_duplicates()
+        analysis['num_escolas'] = nomes.nunique()
+        analysis['nomes_escolas'] = nomes.tolist()[:10]  # Limita a 10
+    
+    if 'codigo_escola' in cube['dims']:
+        codigos = ordered['codigo_escola'].drop_duplicates()
+        analysis['num_cod_escolas'] = codigos.nunique()
+        analysis['cods_escolas'] = codigos.tolist()[:10]  # Limita a 10
+    
+    return analysis
+
+# Sketches de distribuição: buckets logarítmicos com erro relativo limitado nos quantis
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+SKETCH_BUCKET_OFFSET = 1 << 20  # separa buckets positivos (> 0) e negativos (< 0) do zero
+
+def sketch_bucket_codes(values):
+    """Codifica valores em buckets ordenáveis: negativos < 0 (zero) < positivos"""
+    values = np.asarray(values, dtype='float64')
+    codes = np.zeros(len(values), dtype=np.int64)
+    magnitude = np.abs(values)
+    nonzero = magnitude > 0
+    buckets = np.ceil(np.log(magnitude[nonzero]) / np.log(SKETCH_GAMMA)).astype(np.int64) + SKETCH_BUCKET_OFFSET
+    codes[nonzero] = np.where(values[nonzero] > 0, buckets, -buckets)
+    return codes
+
+def sketch_bucket_values(codes):
+    """Valor representativo de cada bucket (erro relativo ≤ SKETCH_RELATIVE_ACCURACY)"""
+    codes = np.asarray(codes, dtype=np.int64)
+    exponent = np.abs(codes) - SKETCH_BUCKET_OFFSET
+    values = 2 * np.power(SKETCH_GAMMA, exponent.astype('float64')) / (SKETCH_GAMMA + 1)
+    return np.where(codes == 0, 0.0, np.sign(codes) * values)
+
+def make_sketch(count, total, total_sq, minimum, maximum, buckets, counts):
+    """Monta o dicionário do sketch"""
+    return {
+        'count': int(count),
+        'sum': float(total),
+        'sumsq': float(total_sq),
+        'min': float(minimum),
+        'max': float(maximum),
+        'buckets': np.asarray(buckets, dtype=np.int64),
+        'counts': np.asarray(counts, dtype=np.int64)
+    }
+
+def build_sketch(values):
+    """Sketch mesclável de uma métrica: momentos exatos e histograma de buckets para quantis"""
+    values = np.asarray(values, dtype='float64')
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return make_sketch(0, 0.0, 0.0, np.nan, np.nan, [], [])
+    buckets, counts = np.unique(sketch_bucket_codes(values), return_counts=True)
+    return make_sketch(len(values), values.sum(), (values ** 2).sum(), values.min(), values.max(), buckets, counts)
+
+def build_grouped_sketches(keys, values):
+    """Sketches de uma métrica por grupo (ex.: por escola) em uma única passagem vetorizada"""
+    frame = pd.DataFrame({'key': np.asarray(keys), 'value': np.asarray(values, dtype='float64')})
+    frame = frame.dropna()
+    if frame.empty:
+        return {}
+    
+    frame['code'] = sketch_bucket_codes(frame['value'].to_numpy())
+    frame['sq'] = frame['value'] ** 2
+    moments = frame.groupby('key').agg(
+        count=('value', 'count'), total=('value', 'sum'), total_sq=('sq', 'sum'),
+        minimum=('value', 'min'), maximum=('value', 'max')
+    )
+    
+    bucket_counts = frame.groupby(['key', 'code']).size()
+    group_keys = bucket_counts.index.get_level_values('key')
+    codes = bucket_counts.index.get_level_values('code').to_numpy()
+    counts = bucket_counts.to_numpy()
+    # Cada grupo ocupa uma faixa contígua da série ordenada
+    boundaries = np.flatnonzero(np.r_[True, group_keys[1:] != group_keys[:-1], True])
+    
+    sketches = {}
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        key = group_keys[start]
+        row = moments.loc[key]
+        sketches[key] = make_sketch(row['count'], row['total'], row['total_sq'], row['minimum'], row['maximum'],
+                                    codes[start:end], counts[start:end])
+    return sketches
+
+def merge_sketches(sketches):
+    """Combina sketches (arquivos, escolas, regiões) sem voltar aos dados brutos"""
+    sketches = [s for s in sketches if s and s['count'] > 0]
+    if not sketches:
+        return make_sketch(0, 0.0, 0.0, np.nan, np.nan, [], [])
+    if len(sketches) == 1:
+        return sketches[0]
+    
+    buckets, inverse = np.unique(np.concatenate([s['buckets'] for s in sketches]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([s['counts'] for s in sketches])).astype(np.int64)
+    return make_sketch(
+        sum(s['count'] for s in sketches),
+        sum(s['sum'] for s in sketches),
+        sum(s['sumsq'] for s in sketches),
+        min(s['min'] for s in sketches),
+        max(s['max'] for s in sketches),
+        buckets, counts
+    )
+
+def sketch_quantile(sketch, q):
+    """Quantil aproximado (0 ≤ q ≤ 1) com erro relativo limitado"""
+    if not sketch or sketch['count'] == 0:
+        return np.nan
+    rank = q * (sketch['count'] - 1)
+    position = np.searchsorted(np.cumsum(sketch['counts']), rank, side='right')
+    value = sketch_bucket_values(sketch['buckets'][min(position, len(sketch['buckets']) - 1)])
+    return float(np.clip(value, sketch['min'], sketch['max']))
+
+def sketch_stats(sketch):
+    """Média, desvio e quantis principais de um sketch"""
+    count = sketch['count']
+    mean = sketch['sum'] / count if count else np.nan
+    variance = max(sketch['sumsq'] / count - mean ** 2, 0.0) if count else np.nan
+    return {
+        'count': count,
+        'media': mean,
+        'desvio': np.sqrt(variance),
+        'min': sketch['min'],
+        'max': sketch['max'],
+        'p25': sketch_quantile(sketch, 0.25),
+        'mediana': sketch_quantile(sketch, 0.5),
+        'p75': sketch_quantile(sketch, 0.75)
+    }
+
+def sketch_histogram(sketch, nbins=20):
+    """Histograma de largura fixa (bordas e contagens) reconstruído a partir dos buckets"""
+    if not sketch or sketch['count'] == 0:
+        return np.array([]), np.array([])
+    edges = np.linspace(sketch['min'], sketch['max'], nbins + 1)
+    if sketch['min'] == sketch['max']:
+        return np.array([sketch['min'], sketch['max']]), np.array([sketch['count']])
+    # Cada bucket cobre [γ^(i-1), γ^i]; sua contagem é repartida pelas faixas proporcionalmente
+    codes = sketch['buckets']
+    exponent = (np.abs(codes) - SKETCH_BUCKET_OFFSET).astype('float64')
+    upper = np.power(SKETCH_GAMMA, exponent)
+    lower = np.power(SKETCH_GAMMA, exponent - 1)
+    low = np.clip(np.where(codes > 0, lower, np.where(codes < 0, -upper, 0.0)), sketch['min'], sketch['max'])
+    high = np.clip(np.where(codes > 0, upper, np.where(codes < 0, -lower, 0.0)), sketch['min'], sketch['max'])
+    
+    width = np.where(high > low, high - low, 1.0)
+    covered = np.where(
+        (high > low)[:, None],
+        np.clip((edges[None, :] - low[:, None]) / width[:, None], 0, 1),
+        (edges[None, :] >= low[:, None]).astype('float64')
+    )
+    cumulative = (covered * sketch['counts'][:, None]).sum(axis=0)
+    cumulative[0] = 0.0  # valores iguais ao mínimo entram na primeira faixa
+    return edges, np.diff(cumulative)
+
+def build_metric_sketches(df):
+    """Sketches de cada métrica nota_/profic_ para o arquivo inteiro e por escola"""
+    metrics = [col for col in get_metric_columns(df) if col.startswith(('nota_', 'profic_'))]
+    sketches = {'arquivo': {}, 'escolas': {}}
+    
+    for col in metrics:
+        sketches['arquivo'][col] = build_sketch(df[col].to_numpy())
+        if 'codigo_escola' in df.columns:
+            for codigo, sketch in build_grouped_sketches(df['codigo_escola'].to_numpy(), df[col].to_numpy()).items():
+                sketches['escolas'].setdefault(codigo, {})[col] = sketch
+    
+    return sketches
+
+def select_view_sketches(info, view):
+    """Sketches que descrevem exatamente a visão: arquivo inteiro ou conjunto de escolas"""
+    sketches = info.get('sketches')
+    if not sketches or view is None:
+        return None
+    if not view['applied_keys']:
+        return sketches['arquivo']
+    if not set(view['applied_keys']) <= {'codigo_escola', 'nome_escola'} or 'codigo_escola' not in view['cube']['dims']:
+        return None
+    
+    # Região = união das escolas da visão
+    cells = view['cube']['cells'].loc[view['mask']]
+    school_sketches = [sketches['escolas'].get(codigo, {}) for codigo in cells['codigo_escola'].dropna().unique()]
+    metrics = sketches['arquivo'].keys()
+    return {col: merge_sketches([s.get(col) for s in school_sketches]) for col in metrics}
+
+def build_school_ranking(cube):
+    """Tabela por escola: média, posição e percentil em cada disciplina e distribuição de níveis"""
+    if cube is None or 'codigo_escola' not in cube['dims']:
+        return None
+    
+    cells = cube['cells']
+    grouped = cells.groupby('codigo_escola')
+    metrics = [col for col in cube['metrics'] if col.startswith(('nota_', 'profic_'))]
+    
+    table = pd.DataFrame({'alunos': grouped['__rows'].sum()})
+    rede = {}
+    for col in metrics:
+        counts = grouped[f'{col}__count'].sum()
+        media = grouped[f'{col}__sum'].sum() / counts.replace(0, np.nan)
+        table[f'{col}__media'] = media
+        table[f'{col}__posicao'] = media.rank(ascending=False, method='min')
+        # Percentil: % de escolas com média menor ou igual
+        table[f'{col}__percentil'] = media.rank(pct=True, method='max') * 100
+        rede[col] = {
+            'media': cells[f'{col}__sum'].sum() / max(cells[f'{col}__count'].sum(), 1),
+            'escolas': int(media.count())
+        }
+    
+    levels = {}
+    for col in cube['levels']:
+        tallies = cube['level_tallies'][col].groupby(cells['codigo_escola']).sum()
+        percents = tallies.div(tallies.sum(axis=1).replace(0, np.nan), axis=0) * 100
+        levels[col] = [str(nivel) for nivel in tallies.columns]
+        for nivel in tallies.columns:
+            table[f'{col}__nivel__{nivel}'] = percents[nivel]
+        totals = tallies.sum()
+        rede[col] = {str(nivel): value for nivel, value in (totals / max(totals.sum(), 1) * 100).items()}
+    
+    return {
+        'table': table,
+        'metrics': metrics,
+        'levels': levels,
+        'rede': rede
+    }
+
+def lookup_school_ranking(ranking, codigo_escola):
+    """Posição de uma escola na rede (consulta direta pelo índice da tabela)"""
+    if ranking is None or codigo_escola not in ranking['table'].index:
+        return None
+    
+    row = ranking['table'].loc[codigo_escola]
+    result = {
+        'codigo_escola': codigo_escola,
+        'num_escolas': len(ranking['table']),
+        'disciplinas': {},
+        'niveis': {}
+    }
+    for col in ranking['metrics']:
+        if pd.isna(row[f'{col}__media']):
+            continue
+        result['disciplinas'][col] = {
+            'media': round(row[f'{col}__media'], 2),
+            'media_rede': round(ranking['rede'][col]['media'], 2),
+            'posicao': int(row[f'{col}__posicao']),
+            'escolas': ranking['rede'][col]['escolas'],
+            'percentil': round(row[f'{col}__percentil'], 1)
+        }
+    for col, niveis in ranking['levels'].items():
+        result['niveis'][col] = {
+            nivel: {'escola': round(row[f'{col}__nivel__{nivel}'], 2), 'rede': round(ranking['rede'][col][nivel], 2)}
+            for nivel in niveis if pd.notna(row[f'{col}__nivel__{nivel}'])
+        }
+    return result
+
+def load_manifest_ranking(manifest, filename):
+    """Tabela de ranking de um arquivo pré-processado (lida uma vez por sessão)"""
+    file_info = manifest['arquivos'][filename]
+    if 'ranking' not in file_info:
+        return None
+    if '_ranking' not in file_info:
+        ranking = dict(file_info['ranking'])
+        ranking['table'] = pd.read_parquet(os.path.join(manifest['base_dir'], ranking.pop('tabela')))
+        file_info['_ranking'] = ranking
+    return file_info['_ranking']
+
+def format_ranking_context(school_ranking):
+    """Texto de comparação escola × rede para o contexto do Gemini"""
+    context = (f"🏆 COMPARAÇÃO COM A REDE (escola {school_ranking['codigo_escola']} "
+               f"entre {school_ranking['num_escolas']} escolas do arquivo):\n")
+    for col, stats in school_ranking['disciplinas'].items():
+        context += (f"  - {col}: média {stats['media']} (rede {stats['media_rede']}) · "
+                    f"{stats['posicao']}º de {stats['escolas']} · percentil {stats['percentil']}\n")
+    for col, niveis in school_ranking['niveis'].items():
+        context += f"  {col} (escola × rede):\n"
+        for nivel, percent in sorted(niveis.items(), key=lambda x: -x[1]['escola']):
+            context += f"    - {nivel}: {percent['escola']}% × {percent['rede']}%\n"
+    return context + "\n"
+
+def build_dataset_entry(df, filename):
+    """Monta a entrada de um arquivo carregado: dados, análise e agregados pré-calculados"""
+    sketches = build_metric_sketches(df)
+    cube = build_aggregate_cube(df)
+    return {
+        'df': df,
+        'analysis': analyze_dataframe(df, filename, sketches=sketches['arquivo']),
+        'cube': cube,
+        'sketches': sketches,
+        'ranking': build_school_ranking(cube),
+        'spill': None,
+        'resident_bytes': int(df.memory_usage(deep=True).sum()),
+        'last_access': time.monotonic()
+    }
+
+def spill_dataframe(df, directory):
+    """Grava o DataFrame em arquivos colunares .npy (texto vira códigos + categorias)"""
+    os.makedirs(directory, exist_ok=True)
+    columns = []
+    text_bytes = 0
+    
+    for idx, col in enumerate(df.columns):
+        series = df[col]
+        path = os.path.join(directory, f"{idx}.npy")
+        if isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biufmM':
+            np.save(path, series.to_numpy())
+            columns.append({'name': col, 'path': path, 'kind': 'numeric'})
+        else:
+            codes, categories = pd.factorize(series, use_na_sentinel=True)
+            np.save(path, codes.astype(np.int32))
+            categories_path = os.path.join(directory, f"{idx}_categorias.npy")
+            np.save(categories_path, np.asarray(categories, dtype=object), allow_pickle=True)
+            columns.append({
+                'name': col,
+                'path': path,
+                'kind': 'text',
+                'categories': categories_path,
+                'dtype': str(series.dtype)
+            })
+            text_bytes += series.memory_usage(deep=True, index=False)
+    
+    return {
+        'directory': directory,
+        'columns': columns,
+        'num_rows': len(df),
+        'nbytes': int(df.memory_usage(deep=True).sum()),
+        'text_bytes': int(text_bytes)
+    }
+
+def page_in_dataframe(spill, rows=None, columns=None):
+    """Reconstrói o DataFrame a partir dos arquivos mapeados em memória (opcionalmente só algumas linhas/colunas)"""
+    data = {}
+    for column in spill['columns']:
+        if columns is not None and column['name'] not in columns:
+            continue
+        values = np.load(column['path'], mmap_mode='r')
+        if rows is not None:
+            values = values[rows]
+        
+        if column['kind'] == 'numeric':
+            data[column['name']] = values
+        else:
+            # Texto precisa ser materializado; códigos -1 são valores ausentes
+            categories = np.load(column['categories'], allow_pickle=True)
+            codes = np.asarray(values)
+            text = np.empty(len(codes), dtype=object)
+            text[codes >= 0] = categories[codes[codes >= 0]]
+            text[codes < 0] = np.nan
+            # Restaura tipos estendidos (category, string, Int64...)
+            data[column['name']] = text if column['dtype'] == 'object' else pd.array(text, dtype=column['dtype'])
+    
+    index = pd.RangeIndex(spill['num_rows'])[rows] if rows is not None else pd.RangeIndex(spill['num_rows'])
+    return pd.DataFrame(data, index=index, copy=False)
+
+def get_entry_df(info):
+    """Retorna o DataFrame de um arquivo carregado, trazendo-o do disco se foi despejado"""
+    info['last_access'] = time.monotonic()
+    if info.get('store'):
+        # Tabela do banco é lida para quem pediu e não fica na sessão (consultas usam SQL)
+        return read_store_rows(full_store_view(info))
+    if info['df'] is None:
+        info['df'] = page_in_dataframe(info['spill'])
+    return info['df']
+
+def get_entry_rows(info, positions):
+    """Retorna apenas algumas linhas de um arquivo carregado, sem trazê-lo inteiro do disco"""
+    positions = list(positions)
+    if info['df'] is not None:
+        return info['df'].iloc[positions]
+    if info.get('store'):
+        return read_store_positions(info, positions)
+    return page_in_dataframe(info['spill'], rows=np.asarray(positions, dtype=np.int64))
+
+def entry_resident_bytes(info):
+    """Bytes residentes de um arquivo (colunas numéricas mapeadas do disco não contam)"""
+    if info['df'] is None:
+        return 0
+    if info.get('spill'):
+        return info['spill']['text_bytes']
+    return info['resident_bytes']
+
+def to_jsonable(obj):
+    """Converte análises (com tipos numpy/pandas) em estruturas serializáveis em JSON"""
+    if isinstance(obj, dict):
+        return {str(to_jsonable(k)): to_jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_jsonable(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, pd.Timestamp):
+        return obj.isoformat()
+    return obj
+
+def school_key(codigo_escola):
+    """Normaliza o código da escola para chave de shard (5174, 5174.0 e '5174' -> '5174')"""
+    if isinstance(codigo_escola, (float, np.floating)) and float(codigo_escola).is_integer():
+        codigo_escola = int(codigo_escola)
+    return str(codigo_escola).strip()
+
+def load_shard_manifest(path):
+    """Lê o manifesto gerado por precompute.py"""
+    with open(path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest['base_dir'] = os.path.dirname(os.path.abspath(path))
+    return manifest
+# Armazenamento analítico em SQLite, compartilhado entre os processos do app
+SQLITE_INDEXED_COLUMNS = ['codigo_escola', 'serie_ano', 'turma', 'sexo']
+
+def quote_identifier(name):
+    """Nome de tabela ou coluna entre aspas para uso em SQL"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def sql_contains(value, pattern, ignore_case):
+    """Busca por regex como str.contains do pandas (função contem() nas consultas)"""
+    if value is None:
+        return 0
+    try:
+        return int(re.search(pattern, str(value), re.IGNORECASE if ignore_case else 0) is not None)
+    except re.error:
+        return 0
+
+@contextmanager
+def store_connection(path):
+    """Conexão com o banco (WAL: consultas de outros processos não bloqueiam uma carga)"""
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.create_function('contem', 3, sql_contains, deterministic=True)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS catalogo (
+                arquivo TEXT PRIMARY KEY,
+                tabela TEXT NOT NULL,
+                analise TEXT NOT NULL,
+                ranking TEXT,
+                carregado_em TEXT NOT NULL
+            )
+        """)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def store_table_name(filename):
+    """Nome da tabela de alunos de um arquivo no banco"""
+    return f"alunos_{hashlib.sha1(filename.encode('utf-8')).hexdigest()[:12]}"
+
+def save_to_store(path, filename, df, analysis, ranking):
+    """Grava os alunos de um arquivo no banco, com índices nas dimensões de filtro, e registra no catálogo"""
+    table = store_table_name(filename)
+    ranking_meta = None
+    with store_connection(path) as conn:
+        conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(table)}")
+        conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(table + '_ranking')}")
+        # rowid segue a ordem das linhas: posição no arquivo = rowid - 1
+        df.to_sql(table, conn, index=False, chunksize=50_000)
+        for col in SQLITE_INDEXED_COLUMNS:
+            if col in df.columns:
+                conn.execute(f"CREATE INDEX {quote_identifier(f'{table}_{col}')} "
+                             f"ON {quote_identifier(table)} ({quote_identifier(col)})")
+        
+        if ranking is not None:
+            ranking['table'].to_sql(table + '_ranking', conn, index=True, index_label='codigo_escola')
+            ranking_meta = {'metrics': ranking['metrics'], 'levels': ranking['levels'], 'rede': to_jsonable(ranking['rede'])}
+        
+        conn.execute(
+            "INSERT OR REPLACE INTO catalogo VALUES (?, ?, ?, ?, ?)",
+            (filename, table, json.dumps(to_jsonable(analysis), ensure_ascii=False),
+             json.dumps(ranking_meta, ensure_ascii=False) if ranking_meta else None,
+             datetime.now().isoformat(timespec='seconds'))
+        )
+    logger.info("arquivo gravado no banco %s: %s (%d alunos)", path, filename, len(df))
+
+def build_store_entry(path, table, analysis, ranking_meta):
+    """Entrada de sessão de um arquivo do banco: só a análise e o ranking ficam em memória"""
+    ranking = None
+    if ranking_meta:
+        with store_connection(path) as conn:
+            ranking_table = pd.read_sql(f"SELECT * FROM {quote_identifier(table + '_ranking')}", conn,
+                                        index_col='codigo_escola')
+        ranking = dict(ranking_meta, table=ranking_table)
+    return {
+        'df': None,
+        'analysis': analysis,
+        'cube': None,
+        'sketches': None,
+        'ranking': ranking,
+        'spill': None,
+        'store': {'path': path, 'table': table},
+        'resident_bytes': 0,
+        'last_access': time.monotonic()
+    }
+
+def full_store_view(info):
+    """Visão sem filtros de um arquivo do banco"""
+    return {'info': info, 'where': '1', 'params': [], 'filters': {}, 'filters_applied': [], 'applied_keys': []}
+
+def query_store(info, filters):
+    """Aplica filtros em SQL indexado (mesma semântica de apply_filters_to_dataframe); retorna a visão ou None"""
+    table = quote_identifier(info['store']['table'])
+    columns = info['analysis']['colunas']
+    conditions = []
+    params = []
+    filters_applied = []
+    applied_keys = []
+    
+    with store_connection(info['store']['path']) as conn:
+        for key, value in filters.items():
+            if key not in columns:
+                continue
+            column = quote_identifier(key)
+            if key == 'nome_escola':
+                # Busca parcial case-insensitive
+                condition, args = f"contem({column}, ?, 1)", [str(value)]
+            elif key == 'serie_ano':
+                condition, args = f"contem(CAST({column} AS TEXT), ?, 0)", [str(value)]
+            elif key in ('codigo_escola', 'turma', 'sexo'):
+                condition, args = f"{column} = ?", [value]
+            else:
+                continue
+            
+            # Como no pandas, o filtro só vale se restar algum aluno
+            where = " AND ".join(conditions + [condition])
+            if conn.execute(f"SELECT 1 FROM {table} WHERE {where} LIMIT 1", params + args).fetchone() is None:
+                continue
+            conditions.append(condition)
+            params += args
+            
+            if key == 'nome_escola':
+                value = conn.execute(f"SELECT {column} FROM {table} WHERE {where} ORDER BY rowid LIMIT 1",
+                                     params).fetchone()[0]
+            filters_applied.append(describe_filter(key, value))
+            applied_keys.append(key)
+    
+    if not filters_applied:
+        return None
+    return {
+        'info': info,
+        'where': " AND ".join(conditions),
+        'params': params,
+        'filters': filters,
+        'filters_applied': filters_applied,
+        'applied_keys': applied_keys
+    }
+
+def read_store_rows(view, limit=None, columns=None):
+    """Linhas de alunos da visão, na ordem do arquivo (só as colunas pedidas, se informadas)"""
+    info = view['info']
+    selected = ', '.join(quote_identifier(col) for col in columns) if columns else '*'
+    sql = (f"SELECT rowid - 1 AS __pos, {selected} FROM {quote_identifier(info['store']['table'])} "
+           f"WHERE {view['where']} ORDER BY rowid")
+    params = list(view['params'])
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    with store_connection(info['store']['path']) as conn:
+        df = pd.read_sql(sql, conn, params=params, index_col='__pos')
+    df.index.name = None
+    return df
+
+def read_store_positions(info, positions):
+    """Linhas de alunos pelas posições no arquivo"""
+    if not positions:
+        return read_store_rows(full_store_view(info), limit=0)
+    placeholders = ", ".join("?" * len(positions))
+    view = dict(full_store_view(info), where=f"rowid IN ({placeholders})", params=[int(p) + 1 for p in positions])
+    return read_store_rows(view)
+
+def store_median(conn, view, col, count):
+    """Mediana exata de uma métrica (ordena só as linhas da visão)"""
+    if not count:
+        return np.nan
+    column = quote_identifier(col)
+    rows = conn.execute(
+        f"SELECT {column} FROM {quote_identifier(view['info']['store']['table'])} "
+        f"WHERE {view['where']} AND {column} IS NOT NULL ORDER BY {column} LIMIT ? OFFSET ?",
+        view['params'] + [2 - count % 2, (count - 1) // 2]
+    ).fetchall()
+    return sum(row[0] for row in rows) / len(rows)
+
+def store_metric_stats(view, columns, medians=True):
+    """Total de alunos e contagem, média, mínimo, máximo (e mediana) das métricas da visão"""
+    info = view['info']
+    table = quote_identifier(info['store']['table'])
+    selects = ["COUNT(*)"]
+    for col in columns:
+        column = quote_identifier(col)
+        selects.append(f"COUNT({column}), AVG({column}), MIN({column}), MAX({column})")
+    
+    with store_connection(info['store']['path']) as conn:
+        row = conn.execute(f"SELECT {', '.join(selects)} FROM {table} WHERE {view['where']}", view['params']).fetchone()
+        result = {'total': row[0], 'metrics': {}}
+        for idx, col in enumerate(columns):
+            count, media, minimo, maximo = row[1 + 4 * idx:5 + 4 * idx]
+            stats = {
+                'count': count,
+                'media': np.nan if media is None else media,
+                'min': np.nan if minimo is None else minimo,
+                'max': np.nan if maximo is None else maximo
+            }
+            if medians:
+                stats['mediana'] = store_median(conn, view, col, count)
+            result['metrics'][col] = stats
+    return result
+
+def store_value_counts(conn, view, col):
+    """Contagem de alunos por valor de uma coluna (equivalente a value_counts)"""
+    column = quote_identifier(col)
+    rows = conn.execute(
+        f"SELECT {column}, COUNT(*) FROM {quote_identifier(view['info']['store']['table'])} "
+        f"WHERE {view['where']} AND {column} IS NOT NULL GROUP BY {column} ORDER BY COUNT(*) DESC",
+        view['params']
+    ).fetchall()
+    return dict(rows)
+
+def store_group_means(view, by, columns):
+    """Médias por valor de uma coluna indexada (equivalente a groupby(by)[columns].mean())"""
+    group = quote_identifier(by)
+    averages = ', '.join(f"AVG({quote_identifier(col)}) AS {quote_identifier(col)}" for col in columns)
+    sql = (f"SELECT {group} AS {group}, {averages} FROM {quote_identifier(view['info']['store']['table'])} "
+           f"WHERE {view['where']} AND {group} IS NOT NULL GROUP BY {group} ORDER BY {group}")
+    with store_connection(view['info']['store']['path']) as conn:
+        return pd.read_sql(sql, conn, params=list(view['params']))
+
+def summarize_store_view(view, filename):
+    """Monta a análise de analyze_dataframe com consultas indexadas no banco"""
+    base = view['info']['analysis']
+    table = quote_identifier(view['info']['store']['table'])
+    metrics = list(base.get('numeric_stats', {}))
+    stats = store_metric_stats(view, metrics)
+    
+    analysis = {
+        'filename': filename,
+        'total_alunos': stats['total'],
+        'total_colunas': len(base['colunas']),
+        'colunas': base['colunas'],
+        'filters_applied': view['filters_applied'],
+        'tipo': base['tipo'],
+        'disciplinas': base['disciplinas']
+    }
+    
+    analysis['numeric_stats'] = {
+        col: {key: round(col_stats[key], 2) for key in ['media', 'min', 'max', 'mediana']}
+        for col, col_stats in stats['metrics'].items()
+    }
+    for col, suffix in [('nota_lp', 'lp'), ('nota_mat', 'mat')]:
+        if col in analysis['numeric_stats']:
+            analysis[f'media_{suffix}'] = analysis['numeric_stats'][col]['media']
+            analysis[f'min_{suffix}'] = analysis['numeric_stats'][col]['min']
+            analysis[f'max_{suffix}'] = analysis['numeric_stats'][col]['max']
+    
+    with store_connection(view['info']['store']['path']) as conn:
+        analysis['level_distributions'] = {}
+        for col in base.get('level_distributions', {}):
+            counts = store_value_counts(conn, view, col)
+            total = sum(counts.values())
+            analysis['level_distributions'][col] = {nivel: round(count / total * 100, 2) for nivel, count in counts.items()}
+        
+        for col, key in [('serie_ano', 'series'), ('sexo', 'genero'), ('turma', 'turmas')]:
+            if col in base['colunas']:
+                analysis[key] = store_value_counts(conn, view, col)
+        
+        for col, num_key, list_key in [('nome_escola', 'num_escolas', 'nomes_escolas'),
+                                       ('codigo_escola', 'num_cod_escolas', 'cods_escolas')]:
+            if col in base['colunas']:
+                column = quote_identifier(col)
+                analysis[num_key] = conn.execute(
+                    f"SELECT COUNT(DISTINCT {column}) FROM {table} WHERE {view['where']}", view['params']
+                ).fetchone()[0]
+                # Primeiros valores na ordem do arquivo (como unique())
+                analysis[list_key] = [row[0] for row in conn.execute(
+                    f"SELECT {column} FROM {table} WHERE {view['where']} GROUP BY {column} ORDER BY MIN(rowid) LIMIT 10",
+                    view['params']
+                )]
+    
+    return analysis
+
+# Modo longitudinal: edições diferentes alinhadas por escola × série
+LONGITUDINAL_ALL_SERIES = 'Todas'
+
+def serie_key(serie_ano):
+    """Normaliza a série para o join entre edições ('6º Ano EF', '6' e '6º ano' -> '6º ano')"""
+    text = str(serie_ano).strip().lower()
+    match = re.search(r'\d+', text)
+    if not match:
+        return text
+    return f"{match.group()}ª série" if 'série' in text or 'serie' in text or ' em' in f" {text}" else f"{match.group()}º ano"
+
+def school_series_aggregates(info):
+    """Contagens e somas das notas por escola × série de um arquivo (do cubo ou do banco)"""
+    if info.get('store'):
+        columns = info['analysis'].get('colunas', [])
+        metrics = [col for col in info['analysis'].get('numeric_stats', {}) if col.startswith(('nota_', 'profic_'))]
+        if 'codigo_escola' not in columns:
+            return None
+        serie = quote_identifier('serie_ano') if 'serie_ano' in columns else 'NULL'
+        select = [f"{quote_identifier('codigo_escola')} AS codigo_escola", f"{serie} AS serie_ano", "COUNT(*) AS __rows"]
+        for col in metrics:
+            select += [f"COUNT({quote_identifier(col)}) AS {quote_identifier(col + '__count')}",
+                       f"SUM({quote_identifier(col)}) AS {quote_identifier(col + '__sum')}"]
+        with store_connection(info['store']['path']) as conn:
+            cells = pd.read_sql(f"SELECT {', '.join(select)} FROM {quote_identifier(info['store']['table'])} "
+                                f"GROUP BY 1, 2", conn)
+    else:
+        cube = info.get('cube')
+        if cube is None or 'codigo_escola' not in cube['dims']:
+            return None
+        metrics = [col for col in cube['metrics'] if col.startswith(('nota_', 'profic_'))]
+        by = [col for col in ['codigo_escola', 'serie_ano'] if col in cube['dims']]
+        columns = ['__rows'] + [f'{col}__{stat}' for col in metrics for stat in ['count', 'sum']]
+        cells = cube['cells'].groupby(by, dropna=False, observed=True)[columns].sum().reset_index()
+        if 'serie_ano' not in by:
+            cells['serie_ano'] = None
+    
+    cells['codigo_escola'] = cells['codigo_escola'].map(school_key)
+    cells['serie_ano'] = [LONGITUDINAL_ALL_SERIES if pd.isna(value) else serie_key(value) for value in cells['serie_ano']]
+    by_serie = cells.groupby(['codigo_escola', 'serie_ano']).sum(numeric_only=True)
+    # Linha da escola inteira (todas as séries), ao lado das linhas por série
+    whole = cells.groupby('codigo_escola').sum(numeric_only=True)
+    whole.index = pd.MultiIndex.from_product([whole.index, [LONGITUDINAL_ALL_SERIES]], names=['codigo_escola', 'serie_ano'])
+    aggregates = pd.concat([by_serie[~by_serie.index.isin(whole.index)], whole])
+    return aggregates, metrics
+
+def longitudinal_year(info):
+    """Edição de um arquivo no modo longitudinal (shards de uma escola ficam de fora: não representam a rede)"""
+    return None if info.get('shard') else info['analysis'].get('ano_edicao')
+
+def build_longitudinal_table(entries):
+    """Junta as edições por escola × série (hash join no índice) e pré-calcula variações e tendências"""
+    files_by_year = {}
+    for filename, info in entries.items():
+        year = longitudinal_year(info)
+        if year is not None:
+            files_by_year.setdefault(year, []).append(filename)
+    if len(files_by_year) < 2:
+        return None
+    
+    years, frames, metrics, rede = [], [], [], {}
+    for year in sorted(files_by_year):
+        parts = [school_series_aggregates(entries[filename]) for filename in files_by_year[year]]
+        parts = [part for part in parts if part is not None]
+        if not parts:
+            continue
+        # Arquivos da mesma edição (ex.: EFAI e EFAF separados) somam nas mesmas escolas
+        aggregates = pd.concat([part[0] for part in parts]).groupby(level=[0, 1]).sum()
+        year_metrics = list(dict.fromkeys(col for part in parts for col in part[1]))
+        
+        frame = pd.DataFrame({f'alunos__{year}': aggregates['__rows']}, index=aggregates.index)
+        whole = aggregates.xs(LONGITUDINAL_ALL_SERIES, level='serie_ano')
+        rede[year] = {}
+        for col in year_metrics:
+            frame[f'{col}__{year}'] = aggregates[f'{col}__sum'] / aggregates[f'{col}__count'].replace(0, np.nan)
+            rede[year][col] = whole[f'{col}__sum'].sum() / max(whole[f'{col}__count'].sum(), 1)
+        
+        years.append(year)
+        frames.append(frame)
+        metrics.extend(col for col in year_metrics if col not in metrics)
+    if len(years) < 2:
+        return None
+    
+    table = frames[0].join(frames[1:], how='outer')
+    x = np.array(years, dtype='float64')
+    for col in metrics:
+        yearly = table.reindex(columns=[f'{col}__{year}' for year in years])
+        values = yearly.to_numpy(dtype='float64')
+        
+        # Variação em relação à edição anterior em que a escola aparece
+        previous = yearly.ffill(axis=1).shift(1, axis=1).to_numpy(dtype='float64')
+        for i, year in enumerate(years[1:], start=1):
+            table[f'{col}__delta__{year}'] = values[:, i] - previous[:, i]
+        
+        # Variação primeira -> última edição e inclinação da reta (pontos por ano) por mínimos quadrados
+        observed = ~np.isnan(values)
+        count = observed.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x_mean = (observed * x).sum(axis=1) / count
+            y_mean = np.nansum(values, axis=1) / count
+            x_dev = np.where(observed, x - x_mean[:, None], 0.0)
+            slope = (x_dev * np.nan_to_num(values - y_mean[:, None])).sum(axis=1) / (x_dev ** 2).sum(axis=1)
+        table[f'{col}__edicoes'] = count
+        table[f'{col}__variacao'] = np.where(count >= 2, yearly.ffill(axis=1).iloc[:, -1] - yearly.bfill(axis=1).iloc[:, 0], np.nan)
+        table[f'{col}__tendencia'] = np.where(count >= 2, slope, np.nan)
+    
+    schools = table.xs(LONGITUDINAL_ALL_SERIES, level='serie_ano')
+    return {
+        'anos': years,
+        'arquivos': {year: files_by_year[year] for year in years},
+        'metrics': metrics,
+        'table': table.sort_index(),
+        'rede': rede,
+        'escolas': len(schools),
+        'escolas_todas_edicoes': int(schools[[f'alunos__{year}' for year in years]].notna().all(axis=1).sum())
+    }
+
+def longitudinal_key(entries):
+    """Arquivos com edição identificada: a tabela só é recalculada quando esse conjunto muda"""
+    return tuple(sorted((filename, longitudinal_year(info)) for filename, info in entries.items()
+                        if longitudinal_year(info) is not None))
+
+def lookup_school_evolution(longitudinal, codigo_escola, serie_ano=None):
+    """Evolução de uma escola por série e disciplina (consulta direta pelo índice da tabela)"""
+    key = school_key(codigo_escola)
+    table = longitudinal['table']
+    if key not in table.index.get_level_values('codigo_escola'):
+        return None
+    rows = table.loc[key]
+    
+    series = [LONGITUDINAL_ALL_SERIES] + [serie for serie in rows.index if serie != LONGITUDINAL_ALL_SERIES]
+    if serie_ano is not None:
+        wanted = str(serie_ano)
+        series = [serie for serie in series if re.match(r'\d+', serie) and re.match(r'\d+', serie).group() == wanted] or series[:1]
+    
+    years = longitudinal['anos']
+    result = {'codigo_escola': key, 'anos': years, 'series': {}}
+    for serie in series:
+        if serie not in rows.index:
+            continue
+        row = rows.loc[serie]
+        serie_result = {
+            'alunos': {year: int(row[f'alunos__{year}']) for year in years if pd.notna(row[f'alunos__{year}'])},
+            'disciplinas': {}
+        }
+        for col in longitudinal['metrics']:
+            medias = {year: round(row[f'{col}__{year}'], 2) for year in years
+                      if f'{col}__{year}' in row.index and pd.notna(row[f'{col}__{year}'])}
+            if len(medias) < 2:
+                continue
+            serie_result['disciplinas'][col] = {
+                'medias': medias,
+                'deltas': {year: round(row[f'{col}__delta__{year}'], 2) for year in years[1:]
+                           if pd.notna(row[f'{col}__delta__{year}'])},
+                'variacao': round(row[f'{col}__variacao'], 2),
+                'tendencia': round(row[f'{col}__tendencia'], 2),
+                'rede': {year: round(longitudinal['rede'][year][col], 2) for year in medias if col in longitudinal['rede'][year]}
+            }
+        if serie_result['disciplinas']:
+            result['series'][serie] = serie_result
+    return result if result['series'] else None
+
+def format_longitudinal_context(longitudinal, filters):
+    """Texto de evolução entre edições (da escola citada ou da rede) para o contexto do Gemini"""
+    years = longitudinal['anos']
+    evolution = None
+    if 'codigo_escola' in filters:
+        evolution = lookup_school_evolution(longitudinal, filters['codigo_escola'], filters.get('serie_ano'))
+    
+    if evolution is None:
+        context = f"📈 EVOLUÇÃO DA REDE ENTRE EDIÇÕES ({', '.join(map(str, years))}):\n"
+        for col in longitudinal['metrics']:
+            medias = [f"{year}: {round(longitudinal['rede'][year][col], 2)}" for year in years if col in longitudinal['rede'][year]]
+            if len(medias) >= 2:
+                context += f"  - {col}: {' → '.join(medias)}\n"
+        context += (f"  Escolas presentes em todas as edições: {longitudinal['escolas_todas_edicoes']} "
+                    f"de {longitudinal['escolas']}\n")
+        if 'codigo_escola' in filters:
+            context += f"  (escola {filters['codigo_escola']} não aparece em mais de uma edição)\n"
+        return context + "\n"
+    
+    context = f"📈 EVOLUÇÃO ENTRE EDIÇÕES (escola {evolution['codigo_escola']}, anos {', '.join(map(str, years))}):\n"
+    for serie, serie_result in list(evolution['series'].items())[:6]:
+        alunos = ', '.join(f"{year}: {n}" for year, n in serie_result['alunos'].items())
+        context += f"  {'Todas as séries' if serie == LONGITUDINAL_ALL_SERIES else serie} (alunos — {alunos}):\n"
+        for col, stats in serie_result['disciplinas'].items():
+            steps = []
+            for year, media in stats['medias'].items():
+                delta = stats['deltas'].get(year)
+                steps.append(f"{year}: {media}" + (f" ({delta:+.2f})" if delta is not None else ""))
+            rede = ' → '.join(str(value) for value in stats['rede'].values())
+            context += (f"    - {col}: {' → '.join(steps)} · variação {stats['variacao']:+.2f} · "
+                        f"tendência {stats['tendencia']:+.2f}/ano (rede: {rede})\n")
+    return context + "\n"
+
+def create_data_context(filtered_df_info=None, dataframes=None, manifest=None):
+    """Cria contexto consolidado de dados para o Gemini (geral: arquivos carregados e manifesto)"""
+    
+    context = ""
+    data_source = {}
+    
+    if filtered_df_info:
+        # Modo filtrado
+        df = filtered_df_info['df']
+        filename = filtered_df_info['filename']
+        filters = filtered_df_info.get('filters', [])
+        
+        if df.empty:
+            return f"=== DADOS FILTRADOS ===\n\nNenhum dado encontrado para os filtros: {', '.join(filters)}\n"
+        
+        # Análise pode vir pronta do cubo pré-agregado (df contém só a amostra)
+        analysis = filtered_df_info.get('analysis') or analyze_dataframe(df, filename, filters)
+        context = f"=== ANÁLISE FOCADA (FILTROS APLICADOS) ===\n\n"
+        context += f"🎯 FILTROS ATIVOS: {', '.join(filters)}\n\n"
+        if filtered_df_info.get('school_ranking'):
+            context += format_ranking_context(filtered_df_info['school_ranking'])
+        data_source[filename] = {'df': df, 'analysis': analysis}
+    
+    else:
+        # Modo geral
+        if not dataframes and not manifest:
+            return "Nenhum dado foi carregado ainda."
+        
+        context = "=== VISÃO GERAL DE TODOS OS DADOS ===\n\n"
+        # Só a amostra de cada arquivo é lida (sem trazer do disco arquivos despejados)
+        data_source = {
+            filename: {
+                'df': get_entry_rows(info, range(min(3, info['analysis']['total_alunos']))),
+                'analysis': info['analysis']
+            }
+            for filename, info in dataframes.items()
+        }
+        
+        # Arquivos pré-processados entram pela análise do manifesto (sem carregar alunos)
+        if manifest:
+            for filename, file_info in manifest['arquivos'].items():
+                data_source[f"{filename} (pré-processado)"] = {'df': None, 'analysis': file_info['analysis']}
+    
+    # Gera contexto detalhado
+    for filename, info in data_source.items():
+        df = info['df']
+        analysis = info['analysis']
+        
+        if analysis['total_alunos'] == 0:
+            context += f"📄 {filename}: Nenhum aluno encontrado\n\n"
+            continue
+        
+        context += f"📄 ARQUIVO: {filename}\n"
+        context += f"Tipo: {analysis['tipo']}\n"
+        context += f"Total de alunos: {analysis['total_alunos']}\n\n"
+        
+        # Estatísticas principais
+        if 'media_lp' in analysis:
+            context += f"📊 LÍNGUA PORTUGUESA:\n"
+            context += f"  - Média: {analysis['media_lp']}\n"
+            context += f"  - Mínimo: {analysis['min_lp']}\n"
+            context += f"  - Máximo: {analysis['max_lp']}\n"
+            nota_stats = analysis.get('numeric_stats', {}).get('nota_lp', {})
+            if nota_stats.get('mediana') is not None:
+                context += f"  - Mediana: {nota_stats['mediana']}\n"
+            if nota_stats.get('p25') is not None:
+                context += f"  - Quartis (aprox.): 1º {nota_stats['p25']} · 3º {nota_stats['p75']}\n"
+            context += "\n"
+        
+        if 'media_mat' in analysis:
+            context += f"📊 MATEMÁTICA:\n"
+            context += f"  - Média: {analysis['media_mat']}\n"
+            context += f"  - Mínimo: {analysis['min_mat']}\n"
+            context += f"  - Máximo: {analysis['max_mat']}\n"
+            nota_stats = analysis.get('numeric_stats', {}).get('nota_mat', {})
+            if nota_stats.get('mediana') is not None:
+                context += f"  - Mediana: {nota_stats['mediana']}\n"
+            if nota_stats.get('p25') is not None:
+                context += f"  - Quartis (aprox.): 1º {nota_stats['p25']} · 3º {nota_stats['p75']}\n"
+            context += "\n"
+        
+        # Outras métricas
+        if 'numeric_stats' in analysis and analysis['numeric_stats']:
+            outras_metricas = [k for k in analysis['numeric_stats'].keys() 
+                              if k not in ['nota_lp', 'nota_mat']]
+            if outras_metricas:
+                context += f"📊 OUTRAS DISCIPLINAS/MÉTRICAS:\n"
+                for col in outras_metricas[:5]:  # Limita a 5
+                    stats = analysis['numeric_stats'][col]
+                    context += f"  - {col}: média={stats['media']}, min={stats['min']}, max={stats['max']}\n"
+                context += "\n"
+        
+        # Distribuições de níveis
+        if 'level_distributions' in analysis and analysis['level_distributions']:
+            context += f"📈 DISTRIBUIÇÃO DE NÍVEIS (% de alunos):\n"
+            for col, dist in analysis['level_distributions'].items():
+                context += f"  {col}:\n"
+                for nivel, percent in sorted(dist.items(), key=lambda x: -x[1])[:3]:
+                    context += f"    - {nivel}: {percent}%\n"
+            context += "\n"
+        
+        # Informações de agrupamento
+        if 'series' in analysis:
+            series_info = [f"{k} ({v} alunos)" for k, v in list(analysis['series'].items())[:5]]
+            context += f"📚 Séries/Anos: {', '.join(series_info)}\n"
+        
+        if 'turmas' in analysis:
+            turmas_info = [f"{k} ({v} alunos)" for k, v in list(analysis['turmas'].items())[:5]]
+            context += f"🏫 Turmas: {', '.join(turmas_info)}\n"
+        
+        if 'num_escolas' in analysis and analysis['num_escolas'] > 1:
+            context += f"🏢 Total de escolas: {analysis['num_escolas']}\n"
+            if 'nomes_escolas' in analysis:
+                context += f"   Exemplos: {', '.join(analysis['nomes_escolas'][:3])}\n"
+        
+        # Amostra dos dados
+        if df is not None:
+            context += f"\n📋 AMOSTRA DOS DADOS (3 primeiras linhas):\n"
+            sample = df.head(3).to_string(max_cols=10)
+            context += sample + "\n"
+        
+        context += "\n" + "="*70 + "\n\n"
+    
+    return context
+
+def get_focus_instructions(focus_type):
+    """Retorna instruções específicas para cada foco"""
+    instructions = {
+        "Equipe Gestora": """
+VOCÊ É UM ESPECIALISTA EM GESTÃO EDUCACIONAL. 
+Analise os dados sob perspectiva estratégica:
+- Identifique padrões e tendências nos resultados REAIS dos dados
+- Use NÚMEROS ESPECÍFICOS dos dados fornecidos
+- Foque em métricas agregadas (por escola, turma, disciplina)
+- Proponha planos de ação com metas SMART
+- Sugira intervenções sistêmicas
+- Inclua indicadores de acompanhamento
+- Seja específico, acionável e baseado em DADOS
+""",
+        "Professores": """
+VOCÊ É UM PROFESSOR ESPECIALISTA EM METODOLOGIAS ATIVAS.
+Crie conteúdo prático e engajador:
+- Analise as DIFICULDADES ESPECÍFICAS identificadas nos dados
+- Desenvolva planos de aula de 50 minutos
+- Use metodologias lúdicas e gamificadas
+- Inclua: objetivos claros, materiais, desenvolvimento passo a passo, avaliação
+- Use jogos, desafios, trabalho em grupo
+- Relacione com cotidiano dos alunos
+- Seja CRIATIVO, DIVERTIDO e baseado nas necessidades REAIS dos alunos
+- Utilize as técnicas de Doug Lemov e Princípios de Rosenshine
+""",
+        "Professores Especialistas": """
+VOCÊ É UM FORMADOR DE PROFESSORES.
+Desenvolva conteúdo de formação continuada:
+- Analise as DEFASAGENS ESPECÍFICAS identificadas nos dados
+- Apresente boas práticas pedagógicas baseadas em evidências
+- Sugira atividades "mão na massa" para os professores aplicarem
+- Inclua exemplos práticos e estudos de caso
+- Proponha oficinas e workshops estruturados
+- Forneça materiais de apoio concretos
+- Foque em habilidades BNCC que estão em defasagem
+- Seja PRÁTICO e focado em APLICAÇÃO IMEDIATA
+"""}
+    
+    return instructions.get(focus_type, instructions["Equipe Gestora"])
+
+def filter_dataset_entry(info, filename, filters):
+    """Aplica filtros a um arquivo carregado e retorna os dados filtrados para o contexto (ou None)"""
+    # Com cubo pré-agregado, estatísticas filtradas saem por roll-up das células
+    if info.get('cube') is not None:
+        view = query_cube(info['cube'], filters)
+        if view is None:
+            return None
+        filtered_data = {
+            'df': get_entry_rows(info, cube_sample_positions(view)),
+            'analysis': summarize_cube_view(view, filename, select_view_sketches(info, view)),
+            'filename': filename,
+            'filters': view['filters_applied']
+        }
+        
+        # Visão de uma única escola: posição na rede vem da tabela de ranking
+        if {'codigo_escola', 'nome_escola'} & set(view['applied_keys']) and 'codigo_escola' in view['cube']['dims']:
+            codigos = view['cube']['cells'].loc[view['mask'], 'codigo_escola'].dropna().unique()
+            if len(codigos) == 1:
+                filtered_data['school_ranking'] = lookup_school_ranking(info.get('ranking'), codigos[0])
+        return filtered_data
+    
+    # Arquivo no banco: filtros e estatísticas em SQL indexado, só a amostra vem para a memória
+    if info.get('store'):
+        view = query_store(info, filters)
+        if view is None:
+            return None
+        filtered_data = {
+            'df': read_store_rows(view, limit=3),
+            'analysis': summarize_store_view(view, filename),
+            'filename': filename,
+            'filters': view['filters_applied']
+        }
+        
+        analysis = filtered_data['analysis']
+        if {'codigo_escola', 'nome_escola'} & set(view['applied_keys']) and analysis.get('num_cod_escolas') == 1:
+            codigo = next(c for c in analysis['cods_escolas'] if c is not None)
+            filtered_data['school_ranking'] = lookup_school_ranking(info.get('ranking'), codigo)
+        return filtered_data
+    
+    filtered_df, applied = apply_filters_to_dataframe(get_entry_df(info), filters)
+    if filtered_df is None or filtered_df.empty:
+        return None
+    return {
+        'df': filtered_df,
+        'filename': filename,
+        'filters': applied
+    }
+
+def build_agent_prompt(user_message, data_context, focus, history_context=""):
+    """Monta o prompt completo enviado ao Gemini"""
+    focus_instructions = get_focus_instructions(focus)
+    
+    return f"""
+{focus_instructions}
+
+{data_context}
+
+{history_context}
+
+=== FOCO SELECIONADO ===
+{focus}
+
+=== PERGUNTA DO USUÁRIO ===
+{user_message}
+
+=== INSTRUÇÕES CRÍTICAS ===
+1. Analise CUIDADOSAMENTE os dados fornecidos acima
+2. Use NÚMEROS e ESTATÍSTICAS REAIS dos dados
+3. Se filtros foram aplicados, foque APENAS nos dados filtrados
+4. Seja ESPECÍFICO e PRÁTICO
+5. Formate bem a resposta com títulos e seções claras usando markdown
+6. Use bullet points quando apropriado
+7. Se pedirem visualização, descreva qual tipo seria útil
+8. Se pedirem plano de aula: estruture em 4 momentos de 50 minutos total
+9. Se pedirem plano de ação: inclua diagnóstico, objetivos SMART, ações, cronograma
+10. Se pedirem formação: inclua módulos, oficinas práticas, boas práticas
+
+RESPONDA AGORA DE FORMA COMPLETA E ESTRUTURADA:
+"""